@@ -0,0 +1,296 @@
+import os
+
+# Бот не должен ходить в реальные сервисы: фиктивные ключи и полная выгрузка без локальной базы
+os.environ.setdefault('TELEGRAM_API_KEY', '000000:BENCHMARK')
+os.environ.setdefault('KASPI_AUTH_TOKEN', 'benchmark')
+os.environ.setdefault('KASPI_INCREMENTAL_SYNC', '0')
+os.environ.setdefault('KASPI_TOKEN_RPS', '0')
+os.environ.setdefault('EMAIL_FROM', 'bench@example.com')
+os.environ.setdefault('EMAIL_TO', 'to@example.com')
+os.environ.setdefault('EMAIL_CC', 'cc@example.com')
+
+import argparse
+import bisect
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import kaspi_bot
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Синтетические заказы в формате API Kaspi: магазины из store_mapping, даты вокруг текущего дня
+def make_synthetic_orders(count, now_ms, seed=1):
+    rnd = random.Random(seed)
+    stores = [code for code in kaspi_bot.store_mapping if code != 'Итого']
+    orders = []
+    for number in range(count):
+        planning_date = now_ms + rnd.randint(-3, 1) * DAY_MS + rnd.randint(-12, 12) * 60 * 60 * 1000
+        orders.append({
+            'type': 'orders',
+            'id': str(number),
+            'attributes': {
+                'code': str(100000000 + number),
+                'pickupPointId': rnd.choice(stores),
+                'creationDate': now_ms - rnd.randint(0, kaspi_bot.ORDER_LOOKBACK_DAYS - 1) * DAY_MS - rnd.randint(0, DAY_MS),
+                'kaspiDelivery': {
+                    'courierTransmissionPlanningDate': planning_date,
+                    'courierTransmissionDate': None if rnd.random() < 0.5 else planning_date,
+                },
+            },
+        })
+    return orders
+
+# Записанные заказы сдвигаются во времени так, чтобы самый новый был создан сейчас
+def shift_orders(orders, now_ms):
+    latest = max((order['attributes'].get('creationDate') or 0 for order in orders), default=0)
+    delta = now_ms - latest if latest else 0
+    for order in orders:
+        attributes = order['attributes']
+        if attributes.get('creationDate'):
+            attributes['creationDate'] += delta
+        kaspi_delivery = attributes.get('kaspiDelivery') or {}
+        for key in ('courierTransmissionPlanningDate', 'courierTransmissionDate'):
+            if kaspi_delivery.get(key):
+                kaspi_delivery[key] += delta
+    return orders
+
+# Заказы из файла записи: список заказов, {"data": [...]} или список страниц API
+def load_fixture(path):
+    with open(path, encoding='utf-8') as fixture_file:
+        content = json.load(fixture_file)
+    if isinstance(content, dict):
+        return content['data']
+    if content and isinstance(content[0], dict) and 'data' in content[0]:
+        return [order for page in content for order in page['data']]
+    return content
+
+# Запись текущих заказов из API Kaspi (токены из окружения) в файл для повторного воспроизведения
+def record_fixture(path):
+    start_date, end_date = kaspi_bot.get_date_range()
+    params = kaspi_bot.build_orders_params(start_date, end_date)
+    orders = []
+    for merchant in kaspi_bot.merchants:
+        for page in kaspi_bot.fetch_order_pages(params, merchant):
+            orders.extend(page)
+    with open(path, 'w', encoding='utf-8') as fixture_file:
+        json.dump(orders, fixture_file, ensure_ascii=False)
+    print(f"Записано заказов: {len(orders)} в {path}")
+
+# Локальный сервер, отдающий заказы страницами как /shop/api/v2/orders.
+# fail() задает ошибочные ответы (5xx, 429 с Retry-After, 4xx) для проверки повторов и предохранителя
+class MockKaspiServer:
+    def __init__(self, orders, page_latency=0.0):
+        self.orders = sorted(orders, key=lambda order: order['attributes'].get('creationDate') or 0)
+        self.creation_dates = [order['attributes'].get('creationDate') or 0 for order in self.orders]
+        self.page_latency = page_latency
+        self.requests = 0
+        self.requested_pages = []
+        self._failures = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                page_number = int(query.get('page[number]', ['0'])[0])
+                failure = server._take_failure(page_number)
+                if failure is not None:
+                    status, retry_after = failure
+                    self.send_response(status)
+                    if retry_after is not None:
+                        self.send_header('Retry-After', retry_after)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                page_size = int(query.get('page[size]', ['100'])[0])
+                start_ms = int(query.get('filter[orders][creationDate][$ge]', ['0'])[0])
+                end_ms = int(query.get('filter[orders][creationDate][$le]', [str(10 ** 15)])[0])
+                low = bisect.bisect_left(server.creation_dates, start_ms)
+                high = bisect.bisect_right(server.creation_dates, end_ms)
+                first = low + page_number * page_size
+                page = server.orders[first:min(first + page_size, high)]
+                body = json.dumps({
+                    'data': page,
+                    'meta': {'pageCount': -(-(high - low) // page_size), 'totalCount': high - low},
+                }).encode('utf-8')
+                if server.page_latency:
+                    time.sleep(server.page_latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/vnd.api+json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._httpd.server_address[1]}/shop/api/v2/orders'
+
+    # Следующие times запросов (только страницы page, если она задана) получат ответ status
+    def fail(self, status, times=1, page=None, retry_after=None):
+        with self._lock:
+            self._failures.append({'status': status, 'times': times, 'page': page, 'retry_after': retry_after})
+
+    def _take_failure(self, page_number):
+        with self._lock:
+            self.requests += 1
+            self.requested_pages.append(page_number)
+            for failure in self._failures:
+                if failure['times'] > 0 and failure['page'] in (None, page_number):
+                    failure['times'] -= 1
+                    return failure['status'], failure['retry_after']
+        return None
+
+    def __enter__(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# Минимум, медиана и максимум времени этапа в секундах
+def summarize(samples):
+    return {
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'max': max(samples),
+        'runs': len(samples),
+    }
+
+# Прогон всех этапов /orders и отправки отчета на одном наборе заказов
+def run_stages(repeat):
+    timings = {}
+    counts = {}
+
+    def measure(stage, func):
+        result = None
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            samples.append(time.perf_counter() - started)
+        timings[stage] = summarize(samples)
+        return result
+
+    order_set = measure('page_fetch', kaspi_bot.fetch_order_set)
+    counts['orders'] = len(order_set)
+
+    # Колоночное представление кэшируется в снимке, поэтому строится отдельным этапом на свежей копии
+    measure('build_frame', lambda: kaspi_bot.OrderSet(
+        orders=order_set.orders, start_date=order_set.start_date, end_date=order_set.end_date
+    ).frame)
+    order_set.frame
+
+    overdue_orders = measure('classify_overdue', lambda: kaspi_bot.get_overdue_orders(order_set))
+    pending_orders = measure('classify_pending', lambda: kaspi_bot.get_pending_orders(order_set))
+    counts['overdue'] = sum(kaspi_bot.count_by_store(overdue_orders).values())
+    counts['pending'] = sum(kaspi_bot.count_by_store(pending_orders).values())
+
+    excel_file = measure('create_excel', lambda: kaspi_bot.create_excel(overdue_orders, sheet_name="Overdue Orders"))
+    counts['excel_bytes'] = len(excel_file.getvalue())
+
+    counts_by_store = kaspi_bot.count_by_store(overdue_orders)
+    # Отрисовка кэшируется по содержимому таблицы: сбрасываем кэш, чтобы замерять саму отрисовку
+    def render_statistics():
+        kaspi_bot.table_renderer._cache.clear()
+        return kaspi_bot.create_statistics_screenshot(counts_by_store)
+    statistics_image = measure('create_statistics_screenshot', render_statistics)
+    counts['statistics_image_bytes'] = len(statistics_image.getvalue())
+
+    def build_messages():
+        order_lines = kaspi_bot.iter_order_lines('📦 Задержанные заказы по магазинам:', kaspi_bot.classify_overdue(order_set))
+        chunks = list(kaspi_bot.iter_message_chunks(order_lines))
+        chunks.extend(kaspi_bot.iter_message_chunks(
+            kaspi_bot.iter_statistics_lines('📊 Статистика по задержанным заказам:', counts_by_store)
+        ))
+        return chunks
+    counts['message_chunks'] = len(measure('message_building', build_messages))
+
+    def build_email():
+        excel_file.seek(0)
+        statistics_image.seek(0)
+        return kaspi_bot.build_report_email(excel_file, statistics_image, "Overdue orders OMS", kaspi_bot.OVERDUE_EMAIL_BODY)
+    _, _, email_bytes = measure('email_assembly', build_email)
+    counts['email_bytes'] = len(email_bytes)
+
+    return timings, counts
+
+# Текущий коммит, чтобы результаты разных версий можно было сравнить
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер этапов выгрузки и отчетов на локальном сервере-имитации API Kaspi")
+    parser.add_argument('--orders', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Размеры синтетических наборов заказов (по умолчанию 1000 10000 100000)")
+    parser.add_argument('--fixture', help="JSON-файл с записанными заказами вместо синтетических")
+    parser.add_argument('--record', metavar='PATH', help="Записать текущие заказы из API Kaspi в файл и выйти")
+    parser.add_argument('--repeat', type=int, default=3, help="Повторов каждого этапа")
+    parser.add_argument('--page-latency', type=float, default=0.0, help="Задержка сервера-имитации на страницу, сек.")
+    parser.add_argument('--output', default='benchmark_results.json', help="Куда записать результаты в JSON")
+    args = parser.parse_args()
+
+    if args.record:
+        record_fixture(args.record)
+        return
+
+    logging.getLogger().setLevel(logging.WARNING)
+    kaspi_bot.warm_up_reporting()
+    now_ms = int(time.time() * 1000)
+    if args.fixture:
+        datasets = [(os.path.basename(args.fixture), shift_orders(load_fixture(args.fixture), now_ms))]
+    else:
+        datasets = [(f'synthetic-{size}', make_synthetic_orders(size, now_ms)) for size in args.orders]
+
+    results = {
+        'commit': get_git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'settings': {
+            'repeat': args.repeat,
+            'page_latency': args.page_latency,
+            'fetch_concurrency': kaspi_bot.KASPI_FETCH_CONCURRENCY,
+            'report_format': kaspi_bot.REPORT_FORMAT,
+            'table_image_renderer': kaspi_bot.TABLE_IMAGE_RENDERER,
+        },
+        'datasets': [],
+    }
+
+    for name, orders in datasets:
+        with MockKaspiServer(orders, page_latency=args.page_latency) as server:
+            kaspi_bot.API_URL = server.url
+            timings, counts = run_stages(args.repeat)
+            counts['api_requests'] = server.requests
+        results['datasets'].append({'name': name, 'counts': counts, 'stages': timings})
+
+        print(f"{name}: {counts['orders']} заказов, просрочено {counts['overdue']}, ожидают {counts['pending']}")
+        for stage, timing in timings.items():
+            print(f"  {stage:<30} {timing['median'] * 1000:10.1f} мс (мин. {timing['min'] * 1000:.1f})")
+
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+if __name__ == '__main__':
+    main()
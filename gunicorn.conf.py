@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+# Запуск в нескольких процессах: gunicorn -c gunicorn.conf.py kaspi_bot:app
+os.environ.setdefault('BOT_MULTIPROCESS', '1')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Обработка команд идет в фоновых потоках воркера, запрос вебхука отвечает сразу
+threads = int(os.environ.get('GUNICORN_THREADS', '2'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+
+# Фоновые службы стартуют в каждом воркере после fork; планировщик и оповещения — только в ведущем
+def post_worker_init(worker):
+    import kaspi_bot
+    kaspi_bot.start_background_services(webhook_url=kaspi_bot.WEBHOOK_URL)
@@ -1,45 +1,331 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import os
+import importlib
+import importlib.util
+from dataclasses import dataclass, field, replace
+from typing import Optional
 import requests
 import logging
 from datetime import datetime, timedelta, timezone
 import telebot
-import schedule
-import time 
-import openpyxl
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import pandas as pd
 import smtplib
+import sqlite3
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
 from io import BytesIO
-import base64
+from email.utils import make_msgid, parsedate_to_datetime
+import csv
+import json
+import gzip
+import zipfile
+import io
+import asyncio
 import threading
+import queue
+import random
+import pickle
+from collections import OrderedDict, deque
+from itertools import compress
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from telebot.types import BotCommand
-from flask import Flask, request
+from flask import Flask, request, jsonify
+
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессных блокировок нет, бот работает в одном процессе
+    fcntl = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
+# Рантайм бота: sync — Flask + telebot + потоки, async — aiohttp + python-telegram-bot на одном цикле событий
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'sync')
+
+# Несколько процессов-воркеров (gunicorn): снимки, состояние задач и обработанные обновления — в общей базе,
+# задачи по расписанию и оповещения выполняет только процесс, захвативший блокировку ведущего
+BOT_MULTIPROCESS = os.getenv('BOT_MULTIPROCESS', '0') == '1'
+# Каталог файлов межпроцессных блокировок
+LOCK_DIR = os.getenv('LOCK_DIR', 'locks')
+# Как часто процесс без блокировки ведущего пробует ее захватить, сек.
+LEADER_RETRY_INTERVAL = float(os.getenv('LEADER_RETRY_INTERVAL', '10'))
+
+# Режим запуска: fast — тяжелые библиотеки отчетов грузятся при первом отчете, eager — сразу
+STARTUP_MODE = os.getenv('STARTUP_MODE', 'fast')
+# Через сколько секунд после старта прогревать библиотеки отчетов в фоне (отрицательное — не прогревать)
+STARTUP_WARMUP_DELAY = float(os.getenv('STARTUP_WARMUP_DELAY', '60'))
+
+# Время загрузки модулей и этапов запуска, в секундах
+startup_timings = {}
+
+# Модуль, который импортируется при первом обращении к атрибуту
+class LazyModule:
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        return getattr(self.ensure_loaded(), attr)
+
+    def ensure_loaded(self):
+        if self._module is not None:
+            return self._module
+        started = time.perf_counter()
+        module = importlib.import_module(self._name)
+        if self._setup is not None:
+            self._setup(module)
+        startup_timings[f'import_{self._name}'] = time.perf_counter() - started
+        logging.info(f"Модуль {self._name} загружен за {startup_timings[f'import_{self._name}']:.2f} сек.")
+        self._module = module
+        return module
+
+matplotlib = LazyModule('matplotlib', setup=lambda module: module.use('Agg'))
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+openpyxl = LazyModule('openpyxl')
+Image = LazyModule('PIL.Image')
+ImageDraw = LazyModule('PIL.ImageDraw')
+ImageFont = LazyModule('PIL.ImageFont')
+# Библиотеки асинхронного рантайма нужны только при BOT_RUNTIME=async
+aiohttp = LazyModule('aiohttp')
+web = LazyModule('aiohttp.web')
+telegram = LazyModule('telegram')
+telegram_ext = LazyModule('telegram.ext')
+
+# Загрузка библиотек отчетов и прогрев отрисовки таблиц
+def warm_up_reporting():
+    try:
+        started = time.perf_counter()
+        for module in (np, pd, openpyxl):
+            module.ensure_loaded()
+        table_renderer.warm_up()
+        startup_timings['reporting_warm_up'] = time.perf_counter() - started
+    except Exception as e:
+        logging.error(f"Ошибка при прогреве библиотек отчетов: {e}")
+
+# Границы гистограмм времени (сек.) и количества страниц
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PAGE_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Счетчики, значения и гистограммы в памяти процесса; отдаются в текстовом формате Prometheus на /metrics
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._definitions = {}
+        self._values = {}
+
+    def describe(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        self._definitions[name] = (kind, help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    # Сброс всех значений метрики (например, заказов по магазинам перед записью нового снимка)
+    def clear(self, name):
+        with self._lock:
+            for key in [key for key in self._values if key[0] == name]:
+                del self._values[key]
+
+    def observe(self, name, value, **labels):
+        buckets = self._definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    # Замер времени блока: with metrics.timer('render_seconds', kind='excel'): ...
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted(
+                ((key, {**value, 'buckets': list(value['buckets'])} if isinstance(value, dict) else value) for key, value in self._values.items()),
+                key=lambda item: item[0]
+            )
+        lines = []
+        for name, (kind, help_text, buckets) in self._definitions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric_name, labels), value in values:
+                if metric_name != name:
+                    continue
+                if kind == 'histogram':
+                    for bound, count in zip(buckets, value['buckets']):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {count}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {value["count"]}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {value["count"]}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+# Метки в формате Prometheus: {store="Almaty Mart",status="200"}
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+metrics = Metrics()
+metrics.describe('kaspi_page_seconds', 'histogram', 'Время запроса одной страницы заказов Kaspi, сек.')
+metrics.describe('kaspi_page_requests_total', 'counter', 'Запросы страниц заказов Kaspi по статусу ответа')
+metrics.describe('kaspi_crawl_pages', 'histogram', 'Страниц заказов за одну выгрузку', PAGE_COUNT_BUCKETS)
+metrics.describe('kaspi_crawl_seconds', 'histogram', 'Время выгрузки заказов продавца, сек.')
+metrics.describe('kaspi_orders', 'gauge', 'Заказов в последнем снимке по магазинам')
+metrics.describe('report_render_seconds', 'histogram', 'Время построения файлов и изображений отчета, сек.')
+metrics.describe('email_message_bytes', 'gauge', 'Размер последнего собранного письма с отчетом, байт')
+metrics.describe('smtp_send_seconds', 'histogram', 'Время отправки письма по SMTP, сек.')
+metrics.describe('smtp_messages_total', 'counter', 'Отправленные и неотправленные письма')
+metrics.describe('telegram_send_seconds', 'histogram', 'Время вызова Telegram Bot API, сек.')
+metrics.describe('telegram_retry_after_total', 'counter', 'Ответы 429 от Telegram')
+metrics.describe('alert_polls_total', 'counter', 'Проверки заказов для оповещений по результату')
+metrics.describe('alerts_sent_total', 'counter', 'Отправленные оповещения о непереданных заказах')
+metrics.describe('job_seconds', 'histogram', 'Время выполнения задачи по расписанию, сек.')
+metrics.describe('job_runs_total', 'counter', 'Запуски задач по расписанию по результату')
+metrics.describe('job_last_run_timestamp_seconds', 'gauge', 'Время последнего запуска задачи (unix)')
+
 # Инициализация бота
 API_KEY = os.getenv('TELEGRAM_API_KEY')
-bot = telebot.TeleBot(API_KEY)
+# Обработчики выполняются в UpdateDispatcher, поэтому собственный пул потоков telebot не нужен
+bot = telebot.TeleBot(API_KEY, threaded=False)
+# Адрес вебхука, который регистрируется в Telegram при запуске
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', f'https://nbot-n94j.onrender.com/{API_KEY}')
 
 # Устанавливаем меню команд
 commands = [
     BotCommand('orders', 'Получить список задержанных заказов'),
     BotCommand('pending_orders', 'Получить список заказов, ожидающих передачи'),
     BotCommand('send_report', 'Отправить отчет по задержанным заказам'),
-    BotCommand('send_pending_report', 'Отправить отчет по ожидающим заказам')
+    BotCommand('send_pending_report', 'Отправить отчет по ожидающим заказам'),
+    BotCommand('refresh', 'Обновить данные заказов из Kaspi'),
+    BotCommand('stats', 'Динамика просроченных и ожидающих заказов по магазинам'),
+    BotCommand('order', 'Статус заказа по номеру'),
+    BotCommand('subscribe', 'Подписаться на заказы магазина'),
+    BotCommand('unsubscribe', 'Отписаться от заказов магазина')
 ]
 
-bot.set_my_commands(commands)
+# Регистрация меню команд и вебхука в Telegram — в фоне, чтобы не задерживать запуск
+def register_telegram(webhook_url=None, max_attempts=3):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            started = time.perf_counter()
+            bot.set_my_commands(commands)
+            if webhook_url:
+                bot.set_webhook(url=webhook_url)
+            startup_timings['telegram_registration'] = time.perf_counter() - started
+            logging.info(f"Команды бота зарегистрированы за {time.perf_counter() - started:.2f} сек.")
+            return
+        except Exception as e:
+            logging.error(f"Попытка {attempt}: Ошибка регистрации команд бота: {e}")
+            time.sleep(5 * attempt)
 
 # URL для API
 API_URL = 'https://kaspi.kz/shop/api/v2/orders'
 
+# Формат файла отчета: xlsx, csv или csv.gz
+REPORT_FORMAT = os.getenv('REPORT_FORMAT', 'xlsx')
+
+# Архив классифицированных заказов плановых рассылок: каталог и формат (parquet; csv.gz — только явно, без pyarrow)
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_FORMAT = os.getenv('ARCHIVE_FORMAT', 'parquet')
+# Период графиков /stats по умолчанию и максимальный, дней
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 90
+
+# Отрисовка таблиц статистики: auto (Pillow для небольших таблиц), matplotlib или pillow
+TABLE_IMAGE_RENDERER = os.getenv('TABLE_IMAGE_RENDERER', 'auto')
+TABLE_IMAGE_SIMPLE_MAX_ROWS = int(os.getenv('TABLE_IMAGE_SIMPLE_MAX_ROWS', '20'))
+
+# SMTP сервер для отчетов (для проверки можно указать локальный smtpd без TLS)
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.yandex.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+SMTP_MAX_ATTEMPTS = int(os.getenv('SMTP_MAX_ATTEMPTS', '4'))
+SMTP_BACKOFF_BASE = float(os.getenv('SMTP_BACKOFF_BASE', '2'))
+# Сколько секунд держать открытым простаивающее SMTP соединение
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '120'))
+# Файл отчета больше стольких байт прикладывается к письму в zip (0 — без сжатия)
+EMAIL_ZIP_THRESHOLD = int(os.getenv('EMAIL_ZIP_THRESHOLD', '0'))
+
+# Сколько страниц заказов запрашивать параллельно (1 — последовательно)
+KASPI_FETCH_CONCURRENCY = int(os.getenv('KASPI_FETCH_CONCURRENCY', '4'))
+
+# Повторы и защита от деградации API Kaspi
+KASPI_TIMEOUT = float(os.getenv('KASPI_TIMEOUT', '30'))
+KASPI_MAX_ATTEMPTS = int(os.getenv('KASPI_MAX_ATTEMPTS', '4'))
+KASPI_BACKOFF_BASE = float(os.getenv('KASPI_BACKOFF_BASE', '1'))
+KASPI_BACKOFF_MAX = float(os.getenv('KASPI_BACKOFF_MAX', '30'))
+# После скольких подряд неудачных запросов API считается недоступным и на сколько секунд
+KASPI_CIRCUIT_THRESHOLD = int(os.getenv('KASPI_CIRCUIT_THRESHOLD', '5'))
+KASPI_CIRCUIT_COOLDOWN = float(os.getenv('KASPI_CIRCUIT_COOLDOWN', '60'))
+# Сколько секунд можно продолжать прерванную выгрузку с упавшей страницы
+KASPI_RESUME_WINDOW = float(os.getenv('KASPI_RESUME_WINDOW', '600'))
+# Продавцы Kaspi: JSON-список объектов {"name", "token" или "token_env", "stores": {pickupPointId: название}}.
+# По умолчанию — один продавец с токеном из KASPI_AUTH_TOKEN и магазинами из store_mapping
+KASPI_MERCHANTS = os.getenv('KASPI_MERCHANTS', '')
+# Не больше скольких запросов в секунду отправлять с одним токеном (0 — без ограничения)
+# и сколько запросов подряд можно отправить без паузы после простоя
+KASPI_TOKEN_RPS = float(os.getenv('KASPI_TOKEN_RPS', '10'))
+KASPI_TOKEN_BURST = int(os.getenv('KASPI_TOKEN_BURST', '10'))
+
+# Период выгрузки заказов и фильтры запроса
+ORDER_LOOKBACK_DAYS = 14
+ORDER_FILTERS = {
+    'filter[orders][status]': 'ACCEPTED_BY_MERCHANT',
+    'filter[orders][state]': 'KASPI_DELIVERY'
+}
+
+# Сколько секунд снимок заказов считается актуальным
+ORDER_CACHE_TTL = int(os.getenv('ORDER_CACHE_TTL', '120'))
+
+# Локальная база заказов для инкрементальной синхронизации
+ORDER_STORE_PATH = os.getenv('ORDER_STORE_PATH', 'orders.db')
+KASPI_INCREMENTAL_SYNC = os.getenv('KASPI_INCREMENTAL_SYNC', '1') == '1'
+# Сколько часов до последней синхронизации перезапрашивать (заказы принимаются не сразу после создания)
+ORDER_SYNC_OVERLAP_HOURS = int(os.getenv('ORDER_SYNC_OVERLAP_HOURS', '24'))
+# Как часто делать полную выгрузку за весь период
+ORDER_SYNC_FULL_INTERVAL_HOURS = int(os.getenv('ORDER_SYNC_FULL_INTERVAL_HOURS', '24'))
+
+# Сколько секунд снимок заказов годится для ответов /orders <магазин> и /order <номер> без новой выгрузки
+ORDER_INDEX_MAX_AGE = int(os.getenv('ORDER_INDEX_MAX_AGE', '900'))
+
+# Оповещения о заказах, не переданных курьеру к плановому времени: чаты через запятую.
+# Кроме них оповещения получают чаты, подписанные на магазин заказа (/subscribe); без получателей API не опрашивается
+ALERT_CHAT_IDS = [chat_id.strip() for chat_id in os.getenv('ALERT_CHAT_IDS', '').split(',') if chat_id.strip()]
+# Как часто проверять новые заказы и наступившее плановое время, сек.
+ALERT_POLL_INTERVAL = float(os.getenv('ALERT_POLL_INTERVAL', '120'))
+# На сколько секунд до прошлой проверки перезапрашивать новые заказы
+ALERT_POLL_OVERLAP = float(os.getenv('ALERT_POLL_OVERLAP', '600'))
+# Заказы, опоздавшие больше чем на столько часов, не оповещаются (они есть в ежедневном отчете)
+ALERT_MAX_LATENESS_HOURS = float(os.getenv('ALERT_MAX_LATENESS_HOURS', '24'))
+
 # Таймзона UTC+5
 UTC_PLUS_5 = timezone(timedelta(hours=5))
 
@@ -59,439 +345,2277 @@ store_mapping = {
     "Итого": "Total"
 }
 
-def send_long_message(chat_id, message):
-    max_message_length = 4096
-    while len(message) > max_message_length:
-        bot.send_message(chat_id, message[:max_message_length])
-        message = message[max_message_length:]
-    bot.send_message(chat_id, message)
+# Лимиты Telegram: 4096 символов в сообщении, ~1 сообщение в секунду в личный чат,
+# 20 в минуту в группу и ~30 в секунду на бота
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_PRIVATE_CHAT_INTERVAL = 1.0
+TELEGRAM_GROUP_CHAT_INTERVAL = 3.0
+TELEGRAM_GLOBAL_INTERVAL = 1 / 30
+# Выше скольких заказов список отправляется файлом, а не сообщениями (0 — всегда сообщениями)
+MESSAGE_FILE_THRESHOLD = int(os.getenv('MESSAGE_FILE_THRESHOLD', '300'))
+
+# Темп отправки в Telegram: интервалы по чатам и общий, повтор после 429 с retry_after
+class TelegramPacer:
+    max_attempts = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_chat_send = {}
+        self._next_global_send = 0
+
+    # Резервирует слот отправки и возвращает, сколько секунд до него ждать
+    def reserve(self, chat_id):
+        is_group = not isinstance(chat_id, int) or chat_id < 0
+        interval = TELEGRAM_GROUP_CHAT_INTERVAL if is_group else TELEGRAM_PRIVATE_CHAT_INTERVAL
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_chat_send.get(chat_id, 0), self._next_global_send)
+            self._next_chat_send[chat_id] = send_at + interval
+            self._next_global_send = send_at + TELEGRAM_GLOBAL_INTERVAL
+        return send_at - now
+
+    def delay_chat(self, chat_id, seconds):
+        with self._lock:
+            self._next_chat_send[chat_id] = time.monotonic() + seconds
+
+    # Пауза из ответа 429 (telebot или python-telegram-bot); None — ошибка не связана с лимитом
+    @staticmethod
+    def get_retry_after(error):
+        if isinstance(error, telebot.apihelper.ApiTelegramException):
+            if error.error_code != 429:
+                return None
+            return ((error.result_json or {}).get('parameters') or {}).get('retry_after', 1)
+        return getattr(error, 'retry_after', None)
+
+    # Перед попыткой: файлы при повторе отправляются с начала
+    @staticmethod
+    def _start_attempt(args, kwargs):
+        for value in (*args, *kwargs.values()):
+            if hasattr(value, 'seek'):
+                value.seek(0)
+        return time.perf_counter()
+
+    # После ошибки: True — чат притормаживается до retry_after и попытка повторяется
+    def _should_retry(self, error, chat_id, attempt):
+        retry_after = self.get_retry_after(error)
+        if retry_after is None or attempt == self.max_attempts:
+            return False
+        metrics.inc('telegram_retry_after_total')
+        logging.warning(f"Telegram ограничил частоту отправки, повтор через {retry_after} сек.")
+        self.delay_chat(chat_id, retry_after)
+        return True
+
+    @staticmethod
+    def _finish_attempt(method, started):
+        metrics.observe('telegram_send_seconds', time.perf_counter() - started,
+                        method=getattr(method, '__name__', 'unknown'))
+
+    def call(self, method, chat_id, *args, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            delay = self.reserve(chat_id)
+            if delay > 0:
+                time.sleep(delay)
+            started = self._start_attempt(args, kwargs)
+            try:
+                return method(chat_id, *args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, chat_id, attempt):
+                    raise
+            finally:
+                self._finish_attempt(method, started)
+
+    # То же для корутин python-telegram-bot: ожидание слота не блокирует цикл событий
+    async def call_async(self, method, chat_id, *args, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            delay = self.reserve(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            started = self._start_attempt(args, kwargs)
+            try:
+                return await method(chat_id, *args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, chat_id, attempt):
+                    raise
+            finally:
+                self._finish_attempt(method, started)
+
+telegram_pacer = TelegramPacer()
+
+# Части сообщения в пределах лимита Telegram; строки не разрываются (кроме строк длиннее лимита)
+def iter_message_chunks(lines, max_message_length=TELEGRAM_MESSAGE_LIMIT):
+    buffer = []
+    buffer_length = 0
+
+    for line in lines:
+        while len(line) > max_message_length:
+            if buffer:
+                yield '\n'.join(buffer)
+                buffer = []
+                buffer_length = 0
+            yield line[:max_message_length]
+            line = line[max_message_length:]
+        if buffer and buffer_length + len(line) + 1 > max_message_length:
+            yield '\n'.join(buffer)
+            buffer = []
+            buffer_length = 0
+        buffer.append(line)
+        buffer_length += len(line) + 1
+
+    if buffer:
+        yield '\n'.join(buffer)
+
+# Статусное сообщение, которое редактируется на месте по ходу долгой команды
+class StatusMessage:
+    min_update_interval = 1.5
+
+    def __init__(self, chat_id, text):
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = bot.send_message(chat_id, text).message_id
+        self._last_update = time.monotonic()
+
+    def update(self, text, force=False):
+        if text == self.text:
+            return
+        # Telegram ограничивает частоту редактирования, промежуточные статусы пропускаем
+        if not force and time.monotonic() - self._last_update < self.min_update_interval:
+            return
+        try:
+            bot.edit_message_text(text, self.chat_id, self.message_id)
+            self.text = text
+            self._last_update = time.monotonic()
+        except Exception as e:
+            logging.warning(f"Не удалось обновить статусное сообщение: {e}")
+
+# Обновление статуса по мере обработки потока заказов
+def track_progress(orders, status, text, every=100):
+    count = 0
+    for count, order in enumerate(orders, start=1):
+        if count % every == 0:
+            status.update(f'{text} обработано {count} заказов')
+        yield order
+
+# Части ответа из потока строк: ('message', текст до 4096 символов) или ('document', текстовый файл).
+# Файл или сообщения выбираются заранее по известному размеру count (число заказов; для списка — число строк),
+# поэтому строки не накапливаются и первое сообщение уходит сразу
+def iter_message_parts(lines, file_threshold=None, file_name='orders.txt', count=None):
+    if count is None and isinstance(lines, list):
+        count = len(lines)
+    if file_threshold and count is not None and count > file_threshold:
+        text_file = BytesIO()
+        text_file.name = file_name
+        for number, line in enumerate(lines):
+            text_file.write(('\n' + line if number else line).encode('utf-8'))
+        text_file.seek(0)
+        yield 'document', text_file
+        return
+    for chunk in iter_message_chunks(lines):
+        yield 'message', chunk
+
+# Отправка шагов ответа (iter_message_parts, iter_orders_reply) в чат с соблюдением лимитов Telegram
+def send_reply_steps(chat_id, steps, status=None):
+    for kind, value in steps:
+        if kind == 'status':
+            status.update(value, force=True)
+        elif kind == 'message':
+            telegram_pacer.call(bot.send_message, chat_id, value)
+        elif kind == 'document':
+            telegram_pacer.call(bot.send_document, chat_id, value, visible_file_name=value.name)
+        else:
+            telegram_pacer.call(bot.send_photo, chat_id, value)
+
+# Отправка потока строк сообщениями до 4096 символов без разрыва строк.
+# Если задан file_threshold и count его превышает, строки отправляются одним файлом
+def send_message_lines(chat_id, lines, file_threshold=None, file_name='orders.txt', count=None):
+    send_reply_steps(chat_id, iter_message_parts(lines, file_threshold, file_name, count))
+
+# Строки списка заказов по магазинам: каждый магазин одним блоком.
+# Страницы API не упорядочены по магазинам, поэтому заказы сначала группируются (group_by_store)
+def iter_order_lines(title, orders_by_store):
+    yield title
+    yield ''
+    for store, order_codes in orders_by_store.items():
+        yield f'Магазин {store}:'
+        for order_code in order_codes:
+            yield f'  🔸 Номер заказа: {order_code}'
+
+# Строки статистики по количеству заказов в магазинах
+def iter_statistics_lines(title, counts_by_store):
+    yield title
+    yield ''
+    for store, count in counts_by_store.items():
+        yield f'{store}: {count} заказов'
+    yield ''
+    yield f'✅ Итого: {sum(counts_by_store.values())} заказов'
 
 # Функция для получения диапазона дат
 def get_date_range():
     today = datetime.now(UTC_PLUS_5)
-    start_date = today - timedelta(days=14)
+    start_date = today - timedelta(days=ORDER_LOOKBACK_DAYS)
     return start_date, today
 
-# Функция для получения просроченных заказов с повторными попытками
-def get_overdue_orders():
-    try:
-        start_date, today = get_date_range()
-        cutoff_time = today.replace(hour=23, minute=0, second=0, microsecond=0)
-
-        params = {
-            'page[number]': 0,
-            'page[size]': 100,
-            'filter[orders][creationDate][$ge]': int(start_date.timestamp() * 1000),
-            'filter[orders][creationDate][$le]': int(today.timestamp() * 1000),
-            'filter[orders][status]': 'ACCEPTED_BY_MERCHANT',
-            'filter[orders][state]': 'KASPI_DELIVERY'
-        }
-
-        headers = {
-            'X-Auth-Token': os.getenv('KASPI_AUTH_TOKEN'),
-            'User-Agent': 'PostmanRuntime/7.32.0',
-            'Accept': 'application/vnd.api+json;charset=UTF-8',
-            'Connection': 'keep-alive'
-        }
-
-        logging.info("Отправка запроса к API Kaspi...")
-        logging.info(f"URL: {API_URL}")
-        logging.info(f"Параметры: {params}")
-
-        overdue_orders_by_store = {}
-        page_number = 0
-
-        while True:
-            params['page[number]'] = page_number
-            max_attempts = 2
-            attempt = 1
+# Заказ из API Kaspi в компактном виде (даты в миллисекундах epoch)
+@dataclass(frozen=True)
+class Order:
+    code: str
+    pickup_point_id: str
+    store: str
+    planning_date: Optional[int]
+    transmission_date: Optional[int]
+    creation_date: Optional[int]
+
+# Набор заказов, полученный за один проход по API
+@dataclass
+class OrderSet:
+    orders: list
+    start_date: datetime
+    end_date: datetime
+    fetched_at: datetime = field(default_factory=lambda: datetime.now(UTC_PLUS_5))
+    _frame: Optional[object] = field(default=None, repr=False, compare=False)
+    _index: Optional[object] = field(default=None, repr=False, compare=False)
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __iter__(self):
+        return iter(self.orders)
+
+    # Колоночное представление заказов, строится один раз на снимок
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = build_order_frame(self.orders)
+        return self._frame
+
+    # Индексы по магазину, номеру заказа и дню плановой передачи, строятся один раз на снимок
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = OrderIndex(self.orders)
+        return self._index
+
+# Заголовки запроса к API Kaspi от имени продавца
+def get_kaspi_headers(merchant):
+    return {
+        'X-Auth-Token': merchant.token,
+        'User-Agent': 'PostmanRuntime/7.32.0',
+        'Accept': 'application/vnd.api+json;charset=UTF-8',
+        'Connection': 'keep-alive'
+    }
+
+# Параметры запроса заказов за период
+def build_orders_params(start_date, end_date):
+    return {
+        'page[number]': 0,
+        'page[size]': 100,
+        'filter[orders][creationDate][$ge]': int(start_date.timestamp() * 1000),
+        'filter[orders][creationDate][$le]': int(end_date.timestamp() * 1000),
+        **ORDER_FILTERS
+    }
+
+# Преобразование заказа из ответа API в Order
+def parse_order(order):
+    attributes = order['attributes']
+    kaspi_delivery = attributes.get('kaspiDelivery') or {}
+    pickup_point_id = attributes.get('pickupPointId', 'Неизвестный магазин')
+    return Order(
+        code=attributes.get('code', 'Нет номера заказа'),
+        pickup_point_id=pickup_point_id,
+        store=store_mapping.get(pickup_point_id, pickup_point_id),
+        planning_date=kaspi_delivery.get('courierTransmissionPlanningDate'),
+        transmission_date=kaspi_delivery.get('courierTransmissionDate'),
+        creation_date=attributes.get('creationDate'),
+    )
 
-            while attempt <= max_attempts:
-                try:
-                    response = requests.get(API_URL, params=params, headers=headers)
-                    logging.info(f'Ответ API: {response.status_code}')
-                    response.raise_for_status()
-                    break
-                except requests.exceptions.ConnectionError as e:
-                    logging.error(f"Попытка {attempt}: Ошибка соединения: {e}")
-                    if attempt == max_attempts:
-                        logging.error("Достигнуто максимальное количество попыток. Прерываем.")
-                        return None
-                    attempt += 1
-                    time.sleep(5)
+# Общая сессия с пулом keep-alive соединений к API Kaspi
+_kaspi_session = None
+_kaspi_session_lock = threading.Lock()
+
+def get_kaspi_session():
+    global _kaspi_session
+    with _kaspi_session_lock:
+        if _kaspi_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(KASPI_FETCH_CONCURRENCY, 1) * len(merchants))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _kaspi_session = session
+        return _kaspi_session
+
+# Ошибка API Kaspi, после которой выгрузка не может продолжаться
+class KaspiAPIError(Exception):
+    pass
+
+# API временно считается недоступным: запросы не отправляются до конца паузы
+class KaspiCircuitOpenError(KaspiAPIError):
+    pass
+
+# Предохранитель: после серии ошибок подряд запросы к API сразу отклоняются на время паузы,
+# затем пропускается один пробный запрос
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0
+        self._probe_in_flight = False
+
+    def is_open(self):
+        with self._lock:
+            return self._failures >= self.threshold and time.monotonic() < self._open_until
+
+    # True, если этот вызов — пробный запрос после паузы; его нужно завершить end_probe
+    def before_call(self):
+        with self._lock:
+            if self._failures < self.threshold:
+                return False
+            remaining = self._open_until - time.monotonic()
+            if remaining > 0 or self._probe_in_flight:
+                raise KaspiCircuitOpenError(
+                    f"API Kaspi временно недоступен, повторите через {max(int(remaining), 1)} сек."
+                )
+            self._probe_in_flight = True
+            return True
+
+    # Пробный запрос закончился, даже если исход не записан (неожиданное исключение, отмена):
+    # иначе предохранитель остался бы открытым навсегда
+    def end_probe(self):
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._failures >= self.threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                logging.error(f"API Kaspi недоступен после {self._failures} ошибок подряд, пауза {self.cooldown:.0f} сек.")
+
+# Ограничение частоты запросов (GCRA): слоты идут через interval, после простоя допускается пачка из burst запросов
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._next_at = 0
+
+    # Через сколько секунд можно отправить запрос (слот сразу занимается).
+    # Первые burst запросов после простоя идут без паузы, дальше — не чаще rate в секунду
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            slot_at = max(now, self._next_at)
+            self._next_at = slot_at + self.interval
+            return max(slot_at - now - (self.burst - 1) * self.interval, 0)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+# Продавец Kaspi: свой токен, свои магазины и свой предохранитель; лимит частоты общий для одного токена
+@dataclass
+class Merchant:
+    name: str
+    token_env: str = 'KASPI_AUTH_TOKEN'
+    token_value: Optional[str] = field(default=None, repr=False)
+    stores: dict = field(default_factory=dict)
+    limiter: RateLimiter = field(default_factory=lambda: RateLimiter(KASPI_TOKEN_RPS, KASPI_TOKEN_BURST), repr=False)
+    circuit: CircuitBreaker = field(
+        default_factory=lambda: CircuitBreaker(KASPI_CIRCUIT_THRESHOLD, KASPI_CIRCUIT_COOLDOWN), repr=False
+    )
 
+    # Токен читается при каждом запросе, чтобы его можно было сменить в окружении без перезапуска
+    @property
+    def token(self):
+        return self.token_value or os.getenv(self.token_env)
+
+# Список продавцов из KASPI_MERCHANTS; их магазины добавляются в store_mapping
+def load_merchants():
+    if KASPI_MERCHANTS:
+        configs = json.loads(KASPI_MERCHANTS)
+    else:
+        configs = [{
+            'name': '14576033',
+            'token_env': 'KASPI_AUTH_TOKEN',
+            'stores': {code: name for code, name in store_mapping.items() if code != 'Итого'},
+        }]
+
+    limiters = {}
+    result = []
+    for config in configs:
+        token_env = config.get('token_env', 'KASPI_AUTH_TOKEN')
+        token_key = config.get('token') or f'env:{token_env}'
+        merchant = Merchant(
+            name=str(config['name']),
+            token_env=token_env,
+            token_value=config.get('token'),
+            stores=dict(config.get('stores') or {}),
+            limiter=limiters.setdefault(token_key, RateLimiter(KASPI_TOKEN_RPS, KASPI_TOKEN_BURST)),
+        )
+        store_mapping.update(merchant.stores)
+        result.append(merchant)
+    if not result:
+        raise ValueError("KASPI_MERCHANTS не содержит ни одного продавца")
+    return result
+
+merchants = load_merchants()
+
+# Время и результат последней выгрузки по каждому продавцу
+merchant_fetch_stats = {}
+_merchant_fetch_stats_lock = threading.Lock()
+
+def record_merchant_fetch(merchant, started_at, orders_count=None, error=None):
+    elapsed = time.perf_counter() - started_at
+    metrics.observe('kaspi_crawl_seconds', elapsed, merchant=merchant.name, result='ok' if error is None else 'error')
+    with _merchant_fetch_stats_lock:
+        merchant_fetch_stats[merchant.name] = {
+            'seconds': elapsed,
+            'orders': orders_count,
+            'error': str(error) if error is not None else None,
+            'finished_at': datetime.now(timezone.utc),
+        }
+    if error is None:
+        logging.info(f"Продавец {merchant.name}: {orders_count} заказов за {elapsed:.2f} сек.")
+    else:
+        logging.error(f"Продавец {merchant.name}: ошибка выгрузки через {elapsed:.2f} сек.: {error}")
+
+# Строки для ответа: время последней выгрузки каждого продавца
+def format_merchant_stats():
+    with _merchant_fetch_stats_lock:
+        stats = dict(merchant_fetch_stats)
+    lines = []
+    for merchant in merchants:
+        entry = stats.get(merchant.name)
+        if entry is None:
+            continue
+        if entry['error'] is None:
+            lines.append(f"• {merchant.name}: {entry['orders']} заказов за {entry['seconds']:.1f} сек.")
+        else:
+            lines.append(f"• {merchant.name}: ошибка через {entry['seconds']:.1f} сек.")
+    return '\n'.join(lines)
+
+# Статусы, при которых запрос имеет смысл повторить
+def is_retryable_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+# Пауза перед повтором: Retry-After от сервера или экспоненциальная с полным джиттером
+def get_retry_delay(attempt, retry_after=None):
+    if retry_after:
+        try:
+            return min(float(retry_after), KASPI_BACKOFF_MAX)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return min(max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0), KASPI_BACKOFF_MAX)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(KASPI_BACKOFF_MAX, KASPI_BACKOFF_BASE * 2 ** attempt))
+
+# Повторяемый ответ API Kaspi (429, 5xx)
+class KaspiRetryableError(Exception):
+    pass
+
+# Одна попытка запроса страницы: общая политика синхронного и асинхронного клиентов —
+# предохранитель, разбор статуса ответа, повторы с паузой, журнал и метрики.
+# Клиент только отправляет запрос и ждет паузу своим способом (time.sleep или asyncio.sleep)
+class PageAttempt:
+    def __init__(self, merchant, page_number, attempt):
+        self.merchant = merchant
+        self.page_number = page_number
+        self.attempt = attempt
+        self.is_probe = merchant.circuit.before_call()
+        self.retry_after = None
+        self.status = 'error'
+        self.started = time.perf_counter()
+
+    # Запрос отправляется после ожидания лимита частоты; время ответа считается от этого момента
+    def sent(self):
+        self.started = time.perf_counter()
+
+    # 429 и 5xx повторяются; остальные 4xx — ошибка запроса или токена, повтор не поможет, а сам API доступен
+    def check_status(self, status_code, retry_after=None):
+        self.status = str(status_code)
+        logging.debug(f'Ответ API (страница {self.page_number}): {status_code}')
+        if is_retryable_status(status_code):
+            self.retry_after = retry_after
+            raise KaspiRetryableError(f"{status_code} от API Kaspi")
+        if status_code >= 400:
+            self.merchant.circuit.record_success()
+            raise KaspiAPIError(f"API Kaspi вернул {status_code} для страницы {self.page_number}")
+
+    def succeeded(self):
+        self.merchant.circuit.record_success()
+
+    # Сетевая ошибка или повторяемый ответ: пауза до следующей попытки; после последней — KaspiAPIError
+    def failed(self, error):
+        self.merchant.circuit.record_failure()
+        logging.error(f"Попытка {self.attempt}: Ошибка запроса страницы {self.page_number} ({self.merchant.name}): {error}")
+        if self.attempt == KASPI_MAX_ATTEMPTS:
+            logging.error("Достигнуто максимальное количество попыток. Прерываем.")
+            raise KaspiAPIError(
+                f"Не удалось получить страницу {self.page_number} заказов продавца {self.merchant.name}: {error}"
+            ) from error
+        return get_retry_delay(self.attempt, self.retry_after)
+
+    # Вызывается в finally: пробный запрос предохранителя завершается при любом исходе
+    def finish(self):
+        if self.is_probe:
+            self.merchant.circuit.end_probe()
+        metrics.observe('kaspi_page_seconds', time.perf_counter() - self.started, merchant=self.merchant.name)
+        metrics.inc('kaspi_page_requests_total', merchant=self.merchant.name, status=self.status)
+
+def iter_page_attempts(merchant, page_number):
+    for attempt in range(1, KASPI_MAX_ATTEMPTS + 1):
+        yield PageAttempt(merchant, page_number, attempt)
+
+# Получение одной страницы заказов продавца: таймауты, повторы при сетевых ошибках, 429 и 5xx
+def fetch_orders_page(session, params, page_number, merchant):
+    page_params = dict(params)
+    page_params['page[number]'] = page_number
+    headers = get_kaspi_headers(merchant)
+
+    for attempt in iter_page_attempts(merchant, page_number):
+        try:
+            merchant.limiter.wait()
+            attempt.sent()
+            response = session.get(API_URL, params=page_params, headers=headers, timeout=(10, KASPI_TIMEOUT))
+            attempt.check_status(response.status_code, response.headers.get('Retry-After'))
             data = response.json()
+            attempt.succeeded()
+            return data
+        except (requests.exceptions.RequestException, ValueError, KaspiRetryableError) as e:
+            delay = attempt.failed(e)
+        finally:
+            attempt.finish()
+        time.sleep(delay)
+
+# Заказы страницы и признак последней страницы (пустая или неполная)
+def read_orders_page(data, page_number, page_size):
+    orders = data.get('data') or []
+    if orders:
+        logging.debug(f"На странице {page_number} заказов: {len(orders)}")
+    else:
+        logging.debug("Нет данных на текущей странице")
+    return orders, len(orders) < page_size
+
+# Постраничная выгрузка заказов: первая страница, затем остальные параллельно, в исходном порядке.
+# Вперед запрашивается не больше concurrency страниц: при обрыве или короткой странице лишние страницы
+# не выгружаются, а еще не начатые запросы отменяются. start_page позволяет продолжить прерванную выгрузку
+def fetch_order_pages(params, merchant, concurrency=None, start_page=0):
+    concurrency = concurrency or KASPI_FETCH_CONCURRENCY
+    session = get_kaspi_session()
+    page_size = params['page[size]']
+
+    data = fetch_orders_page(session, params, start_page, merchant)
+    orders, is_last = read_orders_page(data, start_page, page_size)
+    if orders:
+        yield orders
+    if is_last:
+        return
+
+    page_number = start_page + 1
+    page_count = (data.get('meta') or {}).get('pageCount')
+    if concurrency > 1 and page_count and page_count > page_number:
+        executor = ThreadPoolExecutor(max_workers=min(concurrency, page_count - page_number))
+        pending = deque()
+        next_page = page_number
+        try:
+            while page_number < page_count:
+                while next_page < page_count and len(pending) < concurrency:
+                    pending.append(executor.submit(fetch_orders_page, session, params, next_page, merchant))
+                    next_page += 1
+                orders, is_last = read_orders_page(pending.popleft().result(), page_number, page_size)
+                if orders:
+                    yield orders
+                if is_last:
+                    return
+                page_number += 1
+        finally:
+            # Досрочный выход (ошибка, короткая страница, закрытие генератора) не ждет оставшиеся страницы
+            executor.shutdown(wait=False, cancel_futures=True)
 
-            if 'data' not in data or not data['data']:
-                logging.info("Нет данных на текущей странице")
-                break
+    # Последовательный режим, а также добор страниц, появившихся после первого запроса
+    while True:
+        orders, is_last = read_orders_page(fetch_orders_page(session, params, page_number, merchant), page_number, page_size)
+        if orders:
+            yield orders
+        if is_last:
+            return
+        page_number += 1
 
-            logging.info(f"На странице {page_number} заказов: {len(data['data'])}")
+# Поток заказов из API: записи отдаются по мере прихода страниц.
+# Если продавцов несколько, они выгружаются параллельно и заказы отдаются после выгрузки всех
+def iter_orders(start_date=None, end_date=None, resume=False):
+    if start_date is None or end_date is None:
+        start_date, end_date = get_date_range()
+    if len(merchants) > 1:
+        yield from fetch_orders_between(start_date, end_date, resume)
+        return
 
-            for order in data['data']:
-                order_code = order['attributes'].get('code', 'Нет номера заказа')
-                pickup_point = order['attributes'].get('pickupPointId', 'Неизвестный магазин')
-                pickup_point = store_mapping.get(pickup_point, pickup_point)
-                courier_transmission_planning_date = order['attributes'].get('kaspiDelivery', {}).get('courierTransmissionPlanningDate')
-                courier_transmission_date = order['attributes'].get('kaspiDelivery', {}).get('courierTransmissionDate')
+    merchant = merchants[0]
+    params = build_orders_params(start_date, end_date)
 
-                if courier_transmission_planning_date:
-                    planned_date = datetime.fromtimestamp(courier_transmission_planning_date / 1000, tz=UTC_PLUS_5)
-                    if (planned_date < today) or (planned_date.date() == today.date() and planned_date < cutoff_time):
-                        if courier_transmission_date is None:
-                            if pickup_point not in overdue_orders_by_store:
-                                overdue_orders_by_store[pickup_point] = []
-                            overdue_orders_by_store[pickup_point].append(order_code)
+    logging.info("Отправка запроса к API Kaspi...")
 
-            if len(data['data']) < params['page[size]']:
-                break
-            else:
-                page_number += 1
-
-        logging.info(f"Найдено просроченных заказов: {sum(len(orders) for orders in overdue_orders_by_store.values())}")
-        return overdue_orders_by_store
+    started_at = time.perf_counter()
+    orders_count = 0
+    pages_done = 0
+    try:
+        for page in fetch_order_pages(params, merchant):
+            pages_done += 1
+            for order in page:
+                orders_count += 1
+                yield parse_order(order)
+    except KaspiAPIError as e:
+        record_merchant_fetch(merchant, started_at, error=e)
+        raise
+    metrics.observe('kaspi_crawl_pages', pages_done, merchant=merchant.name)
+    record_merchant_fetch(merchant, started_at, orders_count)
+
+# Прерванные выгрузки по продавцам: параметры запроса, уже полученные заказы и страница, с которой продолжить
+_crawl_checkpoints = {}
+
+# Место обрыва полной выгрузки: следующая попытка продолжит с этой страницы
+def save_crawl_checkpoint(merchant, params, orders, next_page):
+    _crawl_checkpoints[merchant.name] = {
+        'params': params,
+        'orders': orders,
+        'next_page': next_page,
+        'saved_at': time.monotonic(),
+    }
+    logging.error(f"Выгрузка продавца {merchant.name} прервана на странице {next_page}, "
+                  f"следующая попытка продолжит с нее")
+
+# Выгрузка страниц; при обрыве полной выгрузки (save_checkpoint) запоминается место обрыва
+def crawl_with_checkpoint(params, orders, merchant, start_page=0, save_checkpoint=True):
+    pages_done = 0
+    try:
+        for page in fetch_order_pages(params, merchant, start_page=start_page):
+            orders.extend(parse_order(order) for order in page)
+            pages_done += 1
+    except KaspiAPIError:
+        if save_checkpoint:
+            save_crawl_checkpoint(merchant, params, orders, start_page + pages_done)
+        raise
+    metrics.observe('kaspi_crawl_pages', pages_done, merchant=merchant.name)
+    return orders
+
+# Можно ли продолжить прерванную выгрузку: те же фильтры и то же окно, сдвинутое вперед по времени
+# (у полной выгрузки окно всегда ORDER_LOOKBACK_DAYS, поэтому $ge сдвигается ровно на столько же, сколько $le)
+def is_resumable_checkpoint(checkpoint_params, params):
+    ge_key = 'filter[orders][creationDate][$ge]'
+    le_key = 'filter[orders][creationDate][$le]'
+    return (
+        all(checkpoint_params.get(key) == value for key, value in ORDER_FILTERS.items())
+        and checkpoint_params[le_key] - checkpoint_params[ge_key] == params[le_key] - params[ge_key]
+        and checkpoint_params[ge_key] <= params[ge_key]
+    )
 
+# План выгрузки продавца за период, общий для синхронного и асинхронного клиентов:
+# уже полученные заказы и шаги (параметры запроса, первая страница).
+# resume — полная выгрузка за окно: недавно прерванная выгрузка продолжается с упавшей страницы,
+# затем догружаются заказы, созданные после нее.
+# Короткие запросы (оповещения, инкрементальная синхронизация) место обрыва не читают и не перезаписывают
+def plan_merchant_crawl(merchant, start_date, end_date, resume=False):
+    params = build_orders_params(start_date, end_date)
+    checkpoint = _crawl_checkpoints.pop(merchant.name, None) if resume else None
+    if checkpoint is not None and time.monotonic() - checkpoint['saved_at'] > KASPI_RESUME_WINDOW:
+        checkpoint = None
+    if checkpoint is None or not is_resumable_checkpoint(checkpoint['params'], params):
+        logging.info(f"Отправка запроса к API Kaspi (продавец {merchant.name})...")
+        return [], [(params, 0)]
+
+    logging.info(f"Продолжение прерванной выгрузки продавца {merchant.name} со страницы {checkpoint['next_page']}")
+    gap_params = dict(params)
+    gap_params['filter[orders][creationDate][$ge]'] = checkpoint['params']['filter[orders][creationDate][$le]'] + 1
+    return checkpoint['orders'], [(checkpoint['params'], checkpoint['next_page']), (gap_params, 0)]
+
+# Заказы продавца после выгрузки: без повторов и без вышедших за начало периода (после продолжения)
+def finish_merchant_crawl(orders, start_date):
+    window_start_ms = int(start_date.timestamp() * 1000)
+    unique_orders = {}
+    for order in orders:
+        if order.creation_date is None or order.creation_date >= window_start_ms:
+            unique_orders[order.code] = order
+    return list(unique_orders.values())
+
+# Получение заказов продавца, созданных в указанный период
+def fetch_merchant_orders(merchant, start_date, end_date, resume=False):
+    orders, steps = plan_merchant_crawl(merchant, start_date, end_date, resume)
+    for params, start_page in steps:
+        crawl_with_checkpoint(params, orders, merchant, start_page, save_checkpoint=resume)
+    return finish_merchant_crawl(orders, start_date)
+
+# Выгрузка одного продавца с замером времени
+def fetch_merchant_orders_timed(merchant, start_date, end_date, resume=False):
+    started_at = time.perf_counter()
+    try:
+        orders = fetch_merchant_orders(merchant, start_date, end_date, resume)
+    except Exception as e:
+        record_merchant_fetch(merchant, started_at, error=e)
+        raise
+    record_merchant_fetch(merchant, started_at, len(orders))
+    return orders
+
+# Объединение результатов продавцов (заказы или исключение у каждого): при ошибке у одного продавца
+# остальные уже успели сохранить свое место обрыва, и пробрасывается первая ошибка
+def merge_merchant_results(results):
+    orders = []
+    errors = []
+    for result in results:
+        if isinstance(result, BaseException):
+            errors.append(result)
+        else:
+            orders.extend(result)
+    if errors:
+        raise errors[0]
+    logging.info(f"Получено заказов: {len(orders)}")
+    return orders
+
+# Получение заказов всех продавцов за период: продавцы выгружаются параллельно, результаты объединяются
+def fetch_orders_between(start_date, end_date, resume=False):
+    if len(merchants) == 1:
+        return merge_merchant_results([fetch_merchant_orders_timed(merchants[0], start_date, end_date, resume)])
+    with ThreadPoolExecutor(max_workers=len(merchants)) as executor:
+        futures = [
+            executor.submit(fetch_merchant_orders_timed, merchant, start_date, end_date, resume)
+            for merchant in merchants
+        ]
+    return merge_merchant_results([future.exception() or future.result() for future in futures])
+
+# Локальное хранилище заказов (SQLite) по номеру заказа
+class OrderStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # База общая для всех процессов-воркеров: ждем освобождения записи вместо ошибки "database is locked"
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        if BOT_MULTIPROCESS:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._conn:
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS orders (
+                    code TEXT PRIMARY KEY,
+                    pickup_point_id TEXT,
+                    planning_date INTEGER,
+                    transmission_date INTEGER,
+                    creation_date INTEGER
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS orders_creation_date ON orders (creation_date)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS alerted_orders (code TEXT PRIMARY KEY, alerted_at INTEGER)')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS daily_store_stats (
+                    day TEXT,
+                    kind TEXT,
+                    store TEXT,
+                    orders INTEGER,
+                    PRIMARY KEY (day, kind, store)
+                )
+            ''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS chat_subscriptions (
+                    chat_id INTEGER,
+                    store TEXT,
+                    PRIMARY KEY (chat_id, store)
+                )
+            ''')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS shared_state (key TEXT PRIMARY KEY, value TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS snapshots (key TEXT PRIMARY KEY, fetched_at INTEGER, payload BLOB)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY, received_at INTEGER)')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS job_claims (
+                    name TEXT,
+                    scheduled_at INTEGER,
+                    claimed_at INTEGER,
+                    PRIMARY KEY (name, scheduled_at)
+                )
+            ''')
+
+    def get_state(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+    # Самая ранняя дата создания среди заказов, еще не переданных курьеру
+    def oldest_open_creation_date(self, since_ms):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT MIN(creation_date) FROM orders WHERE transmission_date IS NULL AND creation_date >= ?',
+                (since_ms,)
+            ).fetchone()
+        return row[0]
+
+    # Замена заказов за перезапрошенный период свежими данными из API
+    def replace_range(self, start_ms, end_ms, orders):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM orders WHERE creation_date BETWEEN ? AND ?', (start_ms, end_ms))
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?, ?)',
+                [(o.code, o.pickup_point_id, o.planning_date, o.transmission_date, o.creation_date) for o in orders]
+            )
+
+    def prune(self, before_ms):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM orders WHERE creation_date < ?', (before_ms,))
+            self._conn.execute('DELETE FROM alerted_orders WHERE alerted_at < ?', (before_ms,))
+
+    # Номера заказов, по которым оповещение еще не отправлялось
+    def unalerted_codes(self, codes):
+        codes = list(codes)
+        with self._lock:
+            alerted = {
+                row[0] for start in range(0, len(codes), 500)
+                for row in self._conn.execute(
+                    f"SELECT code FROM alerted_orders WHERE code IN ({','.join('?' * len(codes[start:start + 500]))})",
+                    codes[start:start + 500]
+                )
+            }
+        return [code for code in codes if code not in alerted]
+
+    # Итоги рассылки за день по магазинам; последняя рассылка дня заменяет предыдущие
+    def replace_daily_stats(self, day, kind, counts_by_store):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM daily_store_stats WHERE day = ? AND kind = ?', (day, kind))
+            self._conn.executemany(
+                'INSERT INTO daily_store_stats (day, kind, store, orders) VALUES (?, ?, ?, ?)',
+                [(day, kind, store, count) for store, count in counts_by_store.items()]
+            )
+
+    def load_daily_stats(self, kind, since_day):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT day, store, orders FROM daily_store_stats WHERE kind = ? AND day >= ? ORDER BY day',
+                (kind, since_day)
+            ).fetchall()
+
+    def mark_alerted(self, code, alerted_at_ms):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO alerted_orders (code, alerted_at) VALUES (?, ?)', (code, alerted_at_ms))
+
+    # Подписки чатов на заказы магазинов
+    def subscribe(self, chat_id, store):
+        with self._lock, self._conn:
+            return self._conn.execute(
+                'INSERT OR IGNORE INTO chat_subscriptions (chat_id, store) VALUES (?, ?)', (chat_id, store)
+            ).rowcount == 1
+
+    def unsubscribe(self, chat_id, store):
+        with self._lock, self._conn:
+            return self._conn.execute(
+                'DELETE FROM chat_subscriptions WHERE chat_id = ? AND store = ?', (chat_id, store)
+            ).rowcount == 1
+
+    def chat_subscriptions(self, chat_id):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT store FROM chat_subscriptions WHERE chat_id = ? ORDER BY store', (chat_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    # Подписчики по магазинам: {магазин: [чаты]}
+    def store_subscribers(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT store, chat_id FROM chat_subscriptions ORDER BY store, chat_id').fetchall()
+        subscribers = {}
+        for store, chat_id in rows:
+            subscribers.setdefault(store, []).append(chat_id)
+        return subscribers
+
+    # Состояние, общее для процессов-воркеров (значения в JSON)
+    def get_shared(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM shared_state WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_shared(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO shared_state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_shared_prefix(self, prefix):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, value FROM shared_state WHERE key >= ? AND key < ?', (prefix, prefix + '\uffff')
+            ).fetchall()
+        return {key[len(prefix):]: json.loads(value) for key, value in rows}
+
+    # Снимок заказов, общий для процессов-воркеров; колоночное представление каждый процесс строит сам
+    def save_snapshot(self, key, order_set):
+        payload = pickle.dumps(replace(order_set, _frame=None, _index=None), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO snapshots (key, fetched_at, payload) VALUES (?, ?, ?)',
+                (key, int(order_set.fetched_at.timestamp() * 1000), payload)
+            )
+
+    def load_snapshot(self, key, newer_than=None):
+        with self._lock:
+            row = self._conn.execute('SELECT fetched_at, payload FROM snapshots WHERE key = ?', (key,)).fetchone()
+        if row is None or (newer_than is not None and row[0] <= int(newer_than.timestamp() * 1000)):
+            return None
+        return pickle.loads(row[1])
+
+    # Обновление Telegram принимается только одним процессом: False, если его уже принял другой
+    def claim_update(self, update_id, received_at_ms, keep_ms=24 * 3600 * 1000):
+        with self._lock, self._conn:
+            claimed = self._conn.execute(
+                'INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)',
+                (update_id, received_at_ms)
+            ).rowcount == 1
+            if claimed:
+                self._conn.execute('DELETE FROM processed_updates WHERE received_at < ?', (received_at_ms - keep_ms,))
+        return claimed
+
+    def release_update(self, update_id):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM processed_updates WHERE update_id = ?', (update_id,))
+
+    # Запуск задачи за плановое время достается только одному процессу
+    def claim_job_run(self, name, scheduled_at_ms, claimed_at_ms):
+        with self._lock, self._conn:
+            return self._conn.execute(
+                'INSERT OR IGNORE INTO job_claims (name, scheduled_at, claimed_at) VALUES (?, ?, ?)',
+                (name, scheduled_at_ms, claimed_at_ms)
+            ).rowcount == 1
+
+    # Заказы, созданные начиная с since_ms (и раньше before_ms, если он задан)
+    def load_orders(self, since_ms, before_ms=None):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT code, pickup_point_id, planning_date, transmission_date, creation_date '
+                'FROM orders WHERE creation_date >= ? AND creation_date < ? ORDER BY pickup_point_id, creation_date',
+                (since_ms, before_ms if before_ms is not None else 2 ** 62)
+            ).fetchall()
+        return [
+            Order(code, pickup_point_id, store_mapping.get(pickup_point_id, pickup_point_id),
+                  planning_date, transmission_date, creation_date)
+            for code, pickup_point_id, planning_date, transmission_date, creation_date in rows
+        ]
+
+_order_store = None
+
+def get_order_store():
+    global _order_store
+    if _order_store is None:
+        _order_store = OrderStore(ORDER_STORE_PATH)
+    return _order_store
+
+# Межпроцессная блокировка на файле: один процесс-воркер внутри блока, остальные ждут
+@contextmanager
+def process_lock(name):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, f'{name}.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# Блокировка ведущего процесса: держится, пока процесс жив, и освобождается ОС при его завершении
+class LeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self):
+        if self._file is not None or fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+# План синхронизации: с какой даты создания перезапрашивать заказы и полная ли это выгрузка
+def plan_order_sync(store, start_date, today):
+    window_start_ms = int(start_date.timestamp() * 1000)
+    now_ms = int(today.timestamp() * 1000)
+    last_sync = store.get_state('last_sync')
+    last_full_sync = store.get_state('last_full_sync')
+
+    full_sync = (
+        last_sync is None or last_full_sync is None
+        or now_ms - last_full_sync > ORDER_SYNC_FULL_INTERVAL_HOURS * 3600 * 1000
+    )
+    if full_sync:
+        delta_start_ms = window_start_ms
+    else:
+        delta_start_ms = last_sync - ORDER_SYNC_OVERLAP_HOURS * 3600 * 1000
+        oldest_open = store.oldest_open_creation_date(window_start_ms)
+        if oldest_open is not None:
+            delta_start_ms = min(delta_start_ms, oldest_open)
+        delta_start_ms = max(delta_start_ms, window_start_ms)
+
+    logging.info(f"{'Полная' if full_sync else 'Инкрементальная'} синхронизация заказов с {from_epoch_ms(delta_start_ms)}")
+    return delta_start_ms, full_sync
+
+# Сохранение результата синхронизации и загрузка актуальных заказов за период
+def apply_order_sync(store, start_date, today, delta_start_ms, full_sync, orders):
+    window_start_ms = int(start_date.timestamp() * 1000)
+    now_ms = int(today.timestamp() * 1000)
+    store.replace_range(delta_start_ms, now_ms, orders)
+    store.prune(window_start_ms)
+    store.set_state('last_sync', now_ms)
+    if full_sync:
+        store.set_state('last_full_sync', now_ms)
+
+    return store.load_orders(window_start_ms)
+
+# Инкрементальная синхронизация: перезапрашиваем только новые заказы и заказы без даты передачи
+def sync_order_store(start_date, today):
+    store = get_order_store()
+    delta_start_ms, full_sync = plan_order_sync(store, start_date, today)
+    orders = fetch_orders_between(from_epoch_ms(delta_start_ms), today, resume=full_sync)
+    return apply_order_sync(store, start_date, today, delta_start_ms, full_sync, orders)
+
+# Ошибки выгрузки приводятся к KaspiAPIError: по ней вызывающий код переходит на сохраненный снимок
+@contextmanager
+def kaspi_fetch_errors():
+    try:
+        yield
+    except KaspiAPIError as e:
+        logging.error(f"Ошибка при запросе к API: {e}")
+        raise
     except Exception as e:
         logging.error(f"Ошибка при запросе к API: {e}")
-        return None
+        raise KaspiAPIError(f"Ошибка при запросе к API Kaspi: {e}") from e
 
-# Функция для получения заказов, ожидающих передачи, с повторными попытками
-def get_pending_orders():
-    try:
+# Получение всех заказов за период (из API целиком или через локальную базу)
+def fetch_order_set():
+    with kaspi_fetch_errors():
         start_date, today = get_date_range()
-        start_of_day = today.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_day = today.replace(hour=23, minute=59, second=59, microsecond=0)
-
-        params = {
-            'page[number]': 0,
-            'page[size]': 100,
-            'filter[orders][creationDate][$ge]': int(start_date.timestamp() * 1000),
-            'filter[orders][creationDate][$le]': int(today.timestamp() * 1000),
-            'filter[orders][status]': 'ACCEPTED_BY_MERCHANT',
-            'filter[orders][state]': 'KASPI_DELIVERY'
-        }
-
-        
-        headers = {
-            'X-Auth-Token': os.getenv('KASPI_AUTH_TOKEN'),
-            'User-Agent': 'PostmanRuntime/7.32.0',
-            'Accept': 'application/vnd.api+json;charset=UTF-8',
-            'Connection': 'keep-alive'
-        }
-
-        logging.info("Отправка запроса к API Kaspi для получения ожидающих заказов...")
-        logging.info(f"URL: {API_URL}")
-        logging.info(f"Параметры: {params}")
-
-        pending_orders_by_store = {}
-        page_number = 0
-
+        if KASPI_INCREMENTAL_SYNC:
+            orders = sync_order_store(start_date, today)
+        else:
+            orders = fetch_orders_between(start_date, today, resume=True)
+        return OrderSet(orders=orders, start_date=start_date, end_date=today)
+
+# Кэш снимков заказов с TTL: одновременные запросы ждут одну выгрузку
+class OrderSnapshotCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._in_flight = {}
+
+    def get(self, key, loader, force_refresh=False):
         while True:
-            params['page[number]'] = page_number
-            max_attempts = 2
-            attempt = 1
-
-            while attempt <= max_attempts:
-                try:
-                    response = requests.get(API_URL, params=params, headers=headers)
-                    logging.info(f'Ответ API: {response.status_code}')
-                    response.raise_for_status()
-                    break
-                except requests.exceptions.ConnectionError as e:
-                    logging.error(f"Попытка {attempt}: Ошибка соединения: {e}")
-                    if attempt == max_attempts:
-                        logging.error("Достигнуто максимальное количество попыток. Прерываем.")
-                        return None
-                    attempt += 1
-                    time.sleep(5)
-
-            data = response.json()
-
-            if 'data' not in data or not data['data']:
-                logging.info("Нет данных на текущей странице")
+            flight, is_leader, snapshot = self._join(key, force_refresh)
+            if snapshot is not None:
+                return snapshot
+            if is_leader:
                 break
+            snapshot = self._wait(flight)
+            if snapshot is not None:
+                return snapshot
 
-            logging.info(f"На странице {page_number} заказов: {len(data['data'])}")
-
-            for order in data['data']:
-                order_code = order['attributes'].get('code', 'Нет номера заказа')
-                pickup_point = order['attributes'].get('pickupPointId', 'Неизвестный магазин')
-                pickup_point = store_mapping.get(pickup_point, pickup_point)
-                courier_transmission_planning_date = order['attributes'].get('kaspiDelivery', {}).get('courierTransmissionPlanningDate')
-                courier_transmission_date = order['attributes'].get('kaspiDelivery', {}).get('courierTransmissionDate')
-
-                # Для точки 9041 (Almaty Warehouse) берем все заказы без фильтра по дате планируемой передачи
-                if pickup_point == store_mapping.get("14576033_9041", "Almaty Warehouse"):
-                    if courier_transmission_date is None:
-                        if pickup_point not in pending_orders_by_store:
-                            pending_orders_by_store[pickup_point] = []
-                        pending_orders_by_store[pickup_point].append(order_code)
-                else:
-                    # Для остальных точек фильтруем по дате планируемой передачи на сегодня
-                    if courier_transmission_planning_date:
-                        planned_date = datetime.fromtimestamp(courier_transmission_planning_date / 1000, tz=UTC_PLUS_5)
-                        if start_of_day <= planned_date <= end_of_day and courier_transmission_date is None:
-                            if pickup_point not in pending_orders_by_store:
-                                pending_orders_by_store[pickup_point] = []
-                            pending_orders_by_store[pickup_point].append(order_code)
-
-            if len(data['data']) < params['page[size]']: 
-                break
-            else:
-                page_number += 1
+        try:
+            flight['result'] = loader()
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            self._finish(key, flight)
 
-        logging.info(f"Найдено заказов, ожидающих передачи: {sum(len(orders) for orders in pending_orders_by_store.values())}")
-        return pending_orders_by_store
+    # Потоковый вариант get: loader — генератор заказов, возвращающий OrderSet в конце
+    def stream(self, key, loader, force_refresh=False):
+        while True:
+            flight, is_leader, snapshot = self._join(key, force_refresh)
+            if snapshot is not None:
+                return iter(snapshot)
+            if is_leader:
+                return self._stream_as_leader(key, flight, loader)
+            snapshot = self._wait(flight)
+            if snapshot is not None:
+                return iter(snapshot)
+
+    # Снимок не старше max_age секунд (по умолчанию TTL) или None
+    def fresh(self, key, max_age=None):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+        if snapshot is not None and snapshot_age(snapshot) <= (self.ttl if max_age is None else max_age):
+            return snapshot
+        return None
 
+    # Сохранение выгруженного снимка; асинхронный рантайм кладет сюда результат своей выгрузки
+    def put(self, key, snapshot):
+        with self._lock:
+            self._snapshots[key] = snapshot
+        record_order_set_metrics(snapshot)
+
+    # Свежий снимок из кэша или участие в выгрузке: (выгрузка, ведет ли ее этот поток, снимок)
+    def _join(self, key, force_refresh):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and not force_refresh and snapshot_age(snapshot) <= self.ttl:
+                return None, False, snapshot
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                return flight, False, None
+            flight = {'done': threading.Event(), 'result': None, 'error': None}
+            self._in_flight[key] = flight
+            return flight, True, None
+
+    def _stream_as_leader(self, key, flight, loader):
+        try:
+            flight['result'] = yield from loader()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            self._finish(key, flight)
+
+    # Результат чужой выгрузки; None — ведущий прервал потоковую выгрузку (GeneratorExit), и ее нужно начать заново
+    def _wait(self, flight):
+        logging.info("Ожидание уже запущенной выгрузки заказов...")
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        if flight['result'] is None:
+            logging.warning("Потоковая выгрузка заказов прервана, выгружаем заново")
+        return flight['result']
+
+    def _finish(self, key, flight):
+        if flight['result'] is not None:
+            self.put(key, flight['result'])
+        with self._lock:
+            del self._in_flight[key]
+        flight['done'].set()
+
+    # Последний сохраненный снимок независимо от TTL
+    def latest(self, key):
+        with self._lock:
+            return self._snapshots.get(key)
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshots.clear()
+
+order_snapshot_cache = OrderSnapshotCache(ORDER_CACHE_TTL)
+
+def get_snapshot_key():
+    return (tuple(sorted(ORDER_FILTERS.items())), ORDER_LOOKBACK_DAYS)
+
+# Выгрузка через общую базу: свежий снимок другого процесса используется без запроса к API,
+# а выгрузку одновременно выполняет только один процесс
+def fetch_shared_order_set(force_refresh=False):
+    store = get_order_store()
+    key = repr(get_snapshot_key())
+    requested_at = datetime.now(UTC_PLUS_5)
+    fresh_after = requested_at if force_refresh else requested_at - timedelta(seconds=ORDER_CACHE_TTL)
+    order_set = store.load_snapshot(key, newer_than=fresh_after)
+    if order_set is not None:
+        return order_set
+
+    with process_lock('fetch'):
+        # Пока ждали блокировку, выгрузку мог завершить другой процесс
+        order_set = store.load_snapshot(key, newer_than=fresh_after)
+        if order_set is not None:
+            logging.info("Используется снимок заказов, выгруженный другим процессом")
+            return order_set
+        order_set = fetch_order_set()
+        store.save_snapshot(key, order_set)
+        return order_set
+
+# Последний снимок в общей базе независимо от возраста
+def load_shared_order_set():
+    try:
+        return get_order_store().load_snapshot(repr(get_snapshot_key()))
     except Exception as e:
-        logging.error(f"Ошибка при запросе к API: {e}")
+        logging.error(f"Не удалось прочитать общий снимок заказов: {e}")
         return None
 
-# Функция для создания Excel файла
+# Последний снимок на случай, если выгрузка не удалась (в памяти или в общей базе).
+# Если API недоступен, возвращается последний снимок — его возраст виден в ответе в чат.
+# Письма и плановые рассылки запрашивают allow_stale=False: в письме и в архиве возраст данных не виден
+def get_fallback_snapshot(error, allow_stale=True):
+    order_set = order_snapshot_cache.latest(get_snapshot_key())
+    if order_set is None and BOT_MULTIPROCESS:
+        order_set = load_shared_order_set()
+    if order_set is None or not allow_stale:
+        return None
+    logging.warning(f"Используется сохраненный снимок заказов: {error}")
+    return order_set
+
+# Снимок заказов из кэша или свежая выгрузка (force_refresh — обход кэша)
+def get_order_snapshot(force_refresh=False, allow_stale=True):
+    if BOT_MULTIPROCESS:
+        loader = lambda: fetch_shared_order_set(force_refresh)
+    else:
+        loader = fetch_order_set
+    try:
+        return order_snapshot_cache.get(get_snapshot_key(), loader, force_refresh=force_refresh)
+    except KaspiAPIError as e:
+        order_set = get_fallback_snapshot(e, allow_stale)
+        if order_set is None:
+            raise
+        return order_set
+
+# Выгрузка заказов потоком; по окончании собранный OrderSet попадает в кэш
+def stream_order_set(force_refresh=False):
+    circuit_open = any(merchant.circuit.is_open() for merchant in merchants)
+    latest = order_snapshot_cache.latest(get_snapshot_key())
+    if latest is None and circuit_open and BOT_MULTIPROCESS:
+        latest = load_shared_order_set()
+    if latest is not None and circuit_open:
+        logging.warning("API Kaspi недоступен, используется сохраненный снимок заказов")
+        yield from latest
+        return latest
+
+    if BOT_MULTIPROCESS:
+        order_set = fetch_shared_order_set(force_refresh)
+        yield from order_set
+        return order_set
+
+    start_date, today = get_date_range()
+    if KASPI_INCREMENTAL_SYNC:
+        # Заказы из локальной базы, которые синхронизация не перезапрашивает, затем новые страницы из API
+        store = get_order_store()
+        delta_start_ms, full_sync = plan_order_sync(store, start_date, today)
+        yield from store.load_orders(int(start_date.timestamp() * 1000), before_ms=delta_start_ms)
+        fetched = []
+        for order in iter_orders(from_epoch_ms(delta_start_ms), today, resume=full_sync):
+            fetched.append(order)
+            yield order
+        orders = apply_order_sync(store, start_date, today, delta_start_ms, full_sync, fetched)
+        return OrderSet(orders=orders, start_date=start_date, end_date=today)
+
+    orders = []
+    for order in iter_orders(start_date, today, resume=True):
+        orders.append(order)
+        yield order
+    logging.info(f"Получено заказов: {len(orders)}")
+    return OrderSet(orders=orders, start_date=start_date, end_date=today)
+
+# Заказы из свежего снимка в кэше или потоком из API по мере прихода страниц
+def iter_order_snapshot(force_refresh=False):
+    return order_snapshot_cache.stream(
+        get_snapshot_key(), lambda: stream_order_set(force_refresh), force_refresh=force_refresh
+    )
+
+# Возраст снимка заказов в секундах
+def snapshot_age(order_set):
+    return (datetime.now(UTC_PLUS_5) - order_set.fetched_at).total_seconds()
+
+# Количество заказов последнего снимка по магазинам для /metrics
+def record_order_set_metrics(order_set):
+    counts_by_store = {}
+    for order in order_set:
+        counts_by_store[order.store] = counts_by_store.get(order.store, 0) + 1
+    metrics.clear('kaspi_orders')
+    for store, count in counts_by_store.items():
+        metrics.set('kaspi_orders', count, store=store)
+
+# Текст о времени получения данных для ответа в чат
+def format_snapshot_age(order_set):
+    return f"🕒 Данные на {order_set.fetched_at.strftime('%H:%M:%S')} ({int(snapshot_age(order_set))} сек. назад)"
+
+# Ответ на /refresh: число заказов, возраст снимка и время выгрузки по продавцам
+def format_refresh_reply(order_set):
+    lines = [f'✅ Данные обновлены: {len(order_set)} заказов.', format_snapshot_age(order_set)]
+    merchant_stats = format_merchant_stats()
+    if merchant_stats:
+        lines.append(merchant_stats)
+    return '\n'.join(lines)
+
+# Перевод времени из миллисекунд epoch в datetime UTC+5
+def from_epoch_ms(value):
+    return datetime.fromtimestamp(value / 1000, tz=UTC_PLUS_5)
+
+# Группировка номеров заказов по магазинам
+def group_by_store(orders):
+    orders_by_store = {}
+    for order in orders:
+        orders_by_store.setdefault(order.store, []).append(order.code)
+    return orders_by_store
+
+# Отбор заказов векторным правилом (overdue_mask, pending_mask) пачками по batch_size:
+# правила существуют в одном месте, а классификаторы по-прежнему принимают поток заказов
+def select_orders(orders, mask, now=None, batch_size=500):
+    today = now or datetime.now(UTC_PLUS_5)
+    batch = []
+    for order in orders:
+        batch.append(order)
+        if len(batch) >= batch_size:
+            yield from compress(batch, mask(build_order_frame(batch), today))
+            batch = []
+    if batch:
+        yield from compress(batch, mask(build_order_frame(batch), today))
+
+# Классификатор: заказы, не переданные курьеру в запланированное время
+def classify_overdue(orders, now=None):
+    return select_orders(orders, overdue_mask, now)
+
+# Классификатор: из просроченных — только те, у которых плановое время передачи уже наступило
+def classify_late(orders, now=None):
+    today = now or datetime.now(UTC_PLUS_5)
+    now_ms = today.timestamp() * 1000
+    for order in classify_overdue(orders, today):
+        if order.planning_date < now_ms:
+            yield order
+
+# Классификатор: заказы, ожидающие передачи курьеру сегодня
+def classify_pending(orders, now=None):
+    return select_orders(orders, pending_mask, now)
+
+# Номер дня по UTC+5 для даты в миллисекундах epoch
+DAY_MS = 24 * 3600 * 1000
+UTC_PLUS_5_OFFSET_MS = int(UTC_PLUS_5.utcoffset(None).total_seconds() * 1000)
+
+def epoch_ms_day(value):
+    return (value + UTC_PLUS_5_OFFSET_MS) // DAY_MS
+
+# Индексы снимка заказов: по номеру, по магазину и по дню плановой передачи.
+# В дневные корзины попадают только заказы, не переданные курьеру, поэтому просроченные и ожидающие
+# заказы магазина отбираются теми же классификаторами, но только среди нужных корзин
+class OrderIndex:
+    def __init__(self, orders):
+        self.by_code = {}
+        self.by_store = {}
+        self.open_by_day = {}
+        for order in orders:
+            self.by_code[order.code] = order
+            self.by_store.setdefault(order.store, []).append(order)
+            if order.transmission_date is None:
+                day = epoch_ms_day(order.planning_date) if order.planning_date else None
+                self.open_by_day.setdefault(order.store, {}).setdefault(day, []).append(order)
+
+    def get(self, code):
+        return self.by_code.get(code)
+
+    def overdue(self, store, now=None):
+        today = now or datetime.now(UTC_PLUS_5)
+        today_day = epoch_ms_day(today.timestamp() * 1000)
+        candidates = [
+            order for day, orders in self.open_by_day.get(store, {}).items()
+            if day is not None and day <= today_day for order in orders
+        ]
+        return sorted(classify_overdue(candidates, today), key=lambda order: order.planning_date)
+
+    def pending(self, store, now=None):
+        today = now or datetime.now(UTC_PLUS_5)
+        days = self.open_by_day.get(store, {})
+        if store == store_mapping.get("14576033_9041", "Almaty Warehouse"):
+            candidates = [order for orders in days.values() for order in orders]
+        else:
+            candidates = days.get(epoch_ms_day(today.timestamp() * 1000), [])
+        return sorted(classify_pending(candidates, today), key=lambda order: order.planning_date or 0)
+
+# Колоночная таблица заказов: даты в int64 миллисекундах (0 — нет даты), магазины категориями
+def build_order_frame(orders):
+    count = len(orders)
+    return pd.DataFrame({
+        'code': [order.code for order in orders],
+        'store': pd.Categorical([order.store for order in orders]),
+        'planning_date': np.fromiter((order.planning_date or 0 for order in orders), dtype=np.int64, count=count),
+        'transmitted': np.fromiter((order.transmission_date is not None for order in orders), dtype=bool, count=count),
+    })
+
+# Границы текущего дня UTC+5 в миллисекундах для векторных правил
+def get_day_bounds_ms(today):
+    start_of_day = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoff_time = today.replace(hour=23, minute=0, second=0, microsecond=0)
+    end_of_day = today.replace(hour=23, minute=59, second=59, microsecond=0)
+    return (
+        start_of_day.timestamp() * 1000,
+        cutoff_time.timestamp() * 1000,
+        end_of_day.timestamp() * 1000,
+    )
+
+# Правило просрочки: плановое время передачи прошло или приходится на сегодня до 23:00, заказ не передан
+def overdue_mask(frame, now=None):
+    today = now or datetime.now(UTC_PLUS_5)
+    start_of_day_ms, cutoff_ms, _ = get_day_bounds_ms(today)
+    planning_date = frame['planning_date'].to_numpy()
+    planned_late = (planning_date < today.timestamp() * 1000) | (
+        (planning_date >= start_of_day_ms) & (planning_date < cutoff_ms)
+    )
+    return (planning_date != 0) & ~frame['transmitted'].to_numpy() & planned_late
+
+# Правило ожидающих передачи: плановая передача сегодня, для Almaty Warehouse — любой не переданный заказ
+def pending_mask(frame, now=None):
+    today = now or datetime.now(UTC_PLUS_5)
+    start_of_day_ms, _, end_of_day_ms = get_day_bounds_ms(today)
+    planning_date = frame['planning_date'].to_numpy()
+    not_transmitted = ~frame['transmitted'].to_numpy()
+    is_warehouse = (frame['store'] == store_mapping.get("14576033_9041", "Almaty Warehouse")).to_numpy()
+    planned_today = (planning_date != 0) & (planning_date >= start_of_day_ms) & (planning_date <= end_of_day_ms)
+    return not_transmitted & (is_warehouse | planned_today)
+
+# Группировка отобранных строк таблицы по магазинам
+def group_frame_by_store(frame, mask):
+    orders_by_store = {}
+    selected = frame[mask]
+    for store, code in zip(selected['store'], selected['code']):
+        orders_by_store.setdefault(store, []).append(code)
+    return orders_by_store
+
+# Функция для получения просроченных заказов
+def get_overdue_orders(order_set=None):
+    if order_set is None:
+        order_set = get_order_snapshot(allow_stale=False)
+    if order_set is None:
+        return None
+    overdue_orders_by_store = group_frame_by_store(order_set.frame, overdue_mask(order_set.frame))
+    logging.info(f"Найдено просроченных заказов: {sum(len(orders) for orders in overdue_orders_by_store.values())}")
+    return overdue_orders_by_store
+
+# Функция для получения заказов, ожидающих передачи
+def get_pending_orders(order_set=None):
+    if order_set is None:
+        order_set = get_order_snapshot(allow_stale=False)
+    if order_set is None:
+        return None
+    pending_orders_by_store = group_frame_by_store(order_set.frame, pending_mask(order_set.frame))
+    logging.info(f"Найдено заказов, ожидающих передачи: {sum(len(orders) for orders in pending_orders_by_store.values())}")
+    return pending_orders_by_store
+
+# Пары (магазин, номер заказа) из словаря по магазинам или из потока Order
+def iter_store_rows(orders):
+    if isinstance(orders, dict):
+        for store, order_codes in orders.items():
+            for order_code in order_codes:
+                yield store, order_code
+    else:
+        for order in orders:
+            yield order.store, order.code
+
+# Имя файла отчета с отметкой времени
+def get_report_file_name(sheet_name, extension):
+    return f"{sheet_name.lower()}_orders_{datetime.now(UTC_PLUS_5).strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+# Функция для создания Excel файла (принимает словарь по магазинам или поток заказов)
+# Книга пишется в потоковом режиме openpyxl: строки не хранятся в памяти как ячейки
 def create_excel(orders_by_store, sheet_name="Orders"):
-    wb = openpyxl.Workbook()
+    wb = openpyxl.Workbook(write_only=True)
     
-    ws1 = wb.active
-    ws1.title = sheet_name
+    ws1 = wb.create_sheet(sheet_name)
     ws1.append(["Store", "Order Number"])
 
-    for store, orders in orders_by_store.items():
-        for order_code in orders:
-            ws1.append([store, order_code])
+    counts_by_store = {}
+    for store, order_code in iter_store_rows(orders_by_store):
+        ws1.append([store, order_code])
+        counts_by_store[store] = counts_by_store.get(store, 0) + 1
 
     ws2 = wb.create_sheet("Statistics")
     ws2.append(["Store", "Number of Orders"])
     
-    total_orders = 0
-    for store, orders in orders_by_store.items():
-        ws2.append([store, len(orders)])
-        total_orders += len(orders)
-
-    ws2.append(["Итого", total_orders])
-
-    file_name = f"{sheet_name.lower()}_orders_{datetime.now(UTC_PLUS_5).strftime('%Y%m%d_%H%M%S')}.xlsx"
-    wb.save(file_name)
-
-    return file_name
-
-# Функция для создания скриншота таблицы
+    for store, count in counts_by_store.items():
+        ws2.append([store, count])
+
+    ws2.append(["Итого", sum(counts_by_store.values())])
+
+    excel_file = BytesIO()
+    excel_file.name = get_report_file_name(sheet_name, 'xlsx')
+    wb.save(excel_file)
+    excel_file.seek(0)
+
+    return excel_file
+
+# CSV отчет (опционально сжатый gzip) — быстрее xlsx для больших выгрузок
+def create_csv(orders_by_store, sheet_name="Orders", compress=False):
+    csv_file = BytesIO()
+    csv_file.name = get_report_file_name(sheet_name, 'csv.gz' if compress else 'csv')
+    raw = gzip.GzipFile(fileobj=csv_file, mode='wb', mtime=0) if compress else csv_file
+
+    # utf-8-sig, чтобы Excel корректно открывал кириллицу
+    text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(["Store", "Order Number"])
+    writer.writerows(iter_store_rows(orders_by_store))
+    text.flush()
+    text.detach()
+    if compress:
+        raw.close()
+    csv_file.seek(0)
+
+    return csv_file
+
+# Файл отчета в формате REPORT_FORMAT
+def create_report_file(orders_by_store, sheet_name="Orders", report_format=None):
+    report_format = report_format or REPORT_FORMAT
+    with metrics.timer('report_render_seconds', kind=report_format):
+        if report_format == 'csv':
+            return create_csv(orders_by_store, sheet_name)
+        if report_format == 'csv.gz':
+            return create_csv(orders_by_store, sheet_name, compress=True)
+        return create_excel(orders_by_store, sheet_name)
+
+# Отрисовка таблиц в PNG: один переиспользуемый шаблон фигуры и кэш готовых картинок по содержимому
+class TableRenderer:
+    cache_size = 32
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._figure = None
+        self._fonts = None
+
+    # Прогрев Agg и шрифтов, чтобы первая команда после холодного старта не платила за них
+    def warm_up(self):
+        started = time.monotonic()
+        sample = pd.DataFrame([("Store", 0), ("Итого", 0)], columns=["Store", "Number of Orders"])
+        with self._lock:
+            self._render_matplotlib(sample)
+            self._render_pillow(sample)
+        logging.info(f"Отрисовка таблиц прогрета за {time.monotonic() - started:.2f} сек.")
+
+    def render(self, df):
+        key = (tuple(df.columns), tuple(tuple(row) for row in df.values.tolist()))
+        with self._lock:
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+                return png
+
+            use_pillow = TABLE_IMAGE_RENDERER == 'pillow' or (
+                TABLE_IMAGE_RENDERER == 'auto' and len(df) <= TABLE_IMAGE_SIMPLE_MAX_ROWS
+            )
+            png = self._render_pillow(df) if use_pillow else self._render_matplotlib(df)
+
+            self._cache[key] = png
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return png
+
+    def _render_matplotlib(self, df):
+        if self._figure is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+            self._figure = Figure()
+            FigureCanvasAgg(self._figure)
+        fig = self._figure
+        fig.clear()
+        fig.set_size_inches(7, max(2, len(df) * 0.4))
+        ax = fig.add_subplot()
+        ax.axis('off')
+
+        table = ax.table(
+            cellText=df.values,
+            colLabels=df.columns,
+            cellLoc='center',
+            loc='center'
+        )
+        table.auto_set_font_size(False)
+        table.set_fontsize(12)
+        table.scale(1, 1.5)
+
+        fig.tight_layout()
+        buffer = BytesIO()
+        fig.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.1)
+        return buffer.getvalue()
+
+    # Простая таблица средствами Pillow: без layout-движка matplotlib, шрифт DejaVu из его поставки
+    def _render_pillow(self, df):
+        if self._fonts is None:
+            fonts_dir = os.path.join(matplotlib.get_data_path(), 'fonts', 'ttf')
+            self._fonts = (
+                ImageFont.truetype(os.path.join(fonts_dir, 'DejaVuSans.ttf'), 24),
+                ImageFont.truetype(os.path.join(fonts_dir, 'DejaVuSans-Bold.ttf'), 24),
+            )
+        font, header_font = self._fonts
+        rows = [[str(value) for value in df.columns]] + [[str(value) for value in row] for row in df.values.tolist()]
+        padding, row_height = 24, 48
+        widths = [
+            max(header_font.getlength(row[column]) for row in rows) + 2 * padding
+            for column in range(len(df.columns))
+        ]
+        widths = [max(width, 280) for width in widths]
+
+        image = Image.new('RGB', (int(sum(widths)) + 1, row_height * len(rows) + 1), 'white')
+        draw = ImageDraw.Draw(image)
+        for row_index, row in enumerate(rows):
+            top = row_index * row_height
+            left = 0
+            for column, text in enumerate(row):
+                right = left + widths[column]
+                draw.rectangle([left, top, right, top + row_height], outline='black', width=1)
+                draw.text(((left + right) / 2, top + row_height / 2), text,
+                          fill='black', font=header_font if row_index == 0 else font, anchor='mm')
+                left = right
+
+        buffer = BytesIO()
+        image.save(buffer, format='PNG', optimize=False)
+        return buffer.getvalue()
+
+table_renderer = TableRenderer()
+
+# Функция для создания скриншота таблицы (filename — путь или буфер)
 def create_table_screenshot(df, filename):
-    fig, ax = plt.subplots(figsize=(7, max(2, len(df) * 0.4)))
-    ax.axis('off')
-
-    table = ax.table(
-        cellText=df.values,
-        colLabels=df.columns,
-        cellLoc='center',
-        loc='center'
+    png = table_renderer.render(df)
+    if hasattr(filename, 'write'):
+        filename.write(png)
+    else:
+        with open(filename, 'wb') as f:
+            f.write(png)
+
+# Количество заказов по магазинам из словаря со списками заказов
+def count_by_store(orders_by_store):
+    return {store: len(orders) for store, orders in orders_by_store.items()}
+
+# Таблица листа "Statistics" без повторного чтения Excel файла
+def build_statistics_table(counts_by_store):
+    rows = list(counts_by_store.items())
+    rows.append(("Итого", sum(counts_by_store.values())))
+    return pd.DataFrame(rows, columns=["Store", "Number of Orders"])
+
+# Функция для создания скриншота статистики в памяти
+def create_statistics_screenshot(counts_by_store):
+    screenshot = BytesIO()
+    screenshot.name = f"statistics_screenshot_{datetime.now(UTC_PLUS_5).strftime('%Y%m%d_%H%M%S')}.png"
+    with metrics.timer('report_render_seconds', kind='statistics_image'):
+        create_table_screenshot(build_statistics_table(counts_by_store), screenshot)
+    screenshot.seek(0)
+    return screenshot
+
+# MIME подтип вложения по расширению файла отчета
+def get_attachment_subtype(file_name):
+    if file_name.endswith('.csv.gz'):
+        return 'gzip'
+    if file_name.endswith('.csv'):
+        return 'csv'
+    return 'xlsx'
+
+# Сжатие файла отчета в zip, если он больше EMAIL_ZIP_THRESHOLD байт (csv.gz уже сжат)
+def prepare_email_attachment(report_file):
+    content = report_file.getvalue()
+    if not EMAIL_ZIP_THRESHOLD or len(content) <= EMAIL_ZIP_THRESHOLD or report_file.name.endswith('.gz'):
+        return content, report_file.name, get_attachment_subtype(report_file.name)
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zip_file:
+        zip_file.writestr(report_file.name, content)
+    logging.info(f"Вложение {report_file.name} сжато в zip: {len(content) // 1024} -> {len(archive.getvalue()) // 1024} КБ")
+    return archive.getvalue(), f'{report_file.name}.zip', 'zip'
+
+# Письмо с отчетом собирается один раз и переиспользуется при повторных попытках и для всех получателей:
+# multipart/mixed из multipart/related (текст, HTML и картинка статистики по Content-ID) и файла отчета
+def build_report_email(excel_file, statistics_image, subject, email_body):
+    started = time.perf_counter()
+    from_email = os.getenv('EMAIL_FROM')
+    to_email = os.getenv('EMAIL_TO').split(',')
+    cc_emails = os.getenv('EMAIL_CC').split(',')
+
+    msg = MIMEMultipart('mixed')
+    msg['From'] = f'Nurbek ASHIRBEK <{from_email}>'
+    msg['To'] = ', '.join(to_email)
+    msg['Cc'] = ', '.join(cc_emails)
+    msg['Subject'] = subject
+
+    image_cid = make_msgid('statistics', domain=from_email.rsplit('@', 1)[-1])[1:-1]
+    html_body = f'''
+    <html>
+        <body>
+            <p>{email_body}</p>
+            <img src="cid:{image_cid}" alt="Statistics Table" style="width: 100%; max-width: 500px;" />
+            <p style="margin-top: 20px;">С уважением,</p>
+            <p>
+                <span style="color: #FF5733; font-weight: bold; font-size: 22px;">Nurbek ASHIRBEK</span><br>
+                <span style="color: #000000;">E-commerce specialist</span>
+            </p>
+        </body>
+    </html>
+    '''
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText(f"{email_body}\n\nС уважением,\nNurbek ASHIRBEK\nE-commerce specialist", 'plain', 'utf-8'))
+    alternative.attach(MIMEText(html_body, 'html', 'utf-8'))
+
+    related = MIMEMultipart('related')
+    related.attach(alternative)
+    image = MIMEImage(statistics_image.getvalue(), _subtype='png')
+    image.add_header('Content-ID', f'<{image_cid}>')
+    image.add_header('Content-Disposition', 'inline', filename=statistics_image.name)
+    related.attach(image)
+    msg.attach(related)
+
+    content, file_name, subtype = prepare_email_attachment(excel_file)
+    attachment = MIMEApplication(content, _subtype=subtype)
+    attachment.add_header('Content-Disposition', 'attachment', filename=file_name)
+    msg.attach(attachment)
+
+    message_bytes = msg.as_bytes()
+    elapsed = time.perf_counter() - started
+    metrics.observe('report_render_seconds', elapsed, kind='email')
+    metrics.set('email_message_bytes', len(message_bytes))
+    logging.info(
+        f"Письмо «{subject}» собрано за {elapsed * 1000:.0f} мс: {len(message_bytes) // 1024} КБ "
+        f"(картинка {len(statistics_image.getvalue()) // 1024} КБ, вложение {len(content) // 1024} КБ), "
+        f"получателей: {len(to_email) + len(cc_emails)}"
     )
-    table.auto_set_font_size(False)
-    table.set_fontsize(12)
-    table.scale(1, 1.5)
-
-    plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight', pad_inches=0.1)
-    plt.close()
-
-# Функция для создания скриншота листа "Statistics"
-def create_statistics_screenshot(file_name):
-    df = pd.read_excel(file_name, sheet_name="Statistics")
-    screenshot_filename = f"statistics_screenshot_{datetime.now(UTC_PLUS_5).strftime('%Y%m%d_%H%M%S')}.png"
-    create_table_screenshot(df, screenshot_filename)
-    return screenshot_filename
-
-# Функция для отправки email с повторными попытками
-def send_email(file_name, subject, email_body):
-    max_attempts = 2
-    attempt = 1
-    screenshot_filename = None
-
-    while attempt <= max_attempts:
-        try:
-            from_email = os.getenv('EMAIL_FROM')
-            to_email = os.getenv('EMAIL_TO').split(',')
-            cc_emails = os.getenv('EMAIL_CC').split(',')
-
-            screenshot_filename = create_statistics_screenshot(file_name)
-            
-            with open(screenshot_filename, "rb") as img_file:
-                img_base64 = base64.b64encode(img_file.read()).decode('utf-8')
-            
-            msg = MIMEMultipart('alternative')
-            msg['From'] = f'Nurbek ASHIRBEK <{from_email}>'
-            msg['To'] = ', '.join(to_email)
-            msg['Cc'] = ', '.join(cc_emails)
-            msg['Subject'] = subject
-
-            html_body = f'''
-            <html>
-                <body>
-                    <p>{email_body}</p>
-                    <img src="data:image/png;base64,{img_base64}" alt="Statistics Table" style="width: 100%; max-width: 500px;" />
-                    <p style="margin-top: 20px;">С уважением,</p>
-                    <p>
-                        <span style="color: #FF5733; font-weight: bold; font-size: 22px;">Nurbek ASHIRBEK</span><br>
-                        <span style="color: #000000;">E-commerce specialist</span>
-                    </p>
-                </body>
-            </html>
-            '''
-            msg.attach(MIMEText(html_body, 'html'))
-
-            with open(file_name, 'rb') as f:
-                attachment = MIMEApplication(f.read(), _subtype="xlsx")
-                attachment.add_header('Content-Disposition', 'attachment', filename=file_name)
-                msg.attach(attachment)
-
-            with open(screenshot_filename, 'rb') as img_file:
-                img_attachment = MIMEApplication(img_file.read(), _subtype="png")
-                img_attachment.add_header('Content-Disposition', 'attachment', filename=screenshot_filename)
-                msg.attach(img_attachment)
-
-            server = smtplib.SMTP('smtp.yandex.com', 587)
+    return from_email, to_email + cc_emails, message_bytes
+
+# Ошибки SMTP, которые бессмысленно повторять (неверные адреса, авторизация, постоянный отказ 5xx)
+def is_permanent_smtp_error(error):
+    if isinstance(error, (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    return False
+
+# Доставка писем: одно авторизованное SMTP соединение, очередь и пакетная отправка
+class MailDelivery:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._server = None
+        self._last_used = 0
+        self._queue = queue.Queue()
+        self._worker = None
+        # Отдельная блокировка запуска обработчика: _lock держится всю отправку пакета вместе с паузами повторов
+        self._worker_lock = threading.Lock()
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        if SMTP_STARTTLS:
             server.starttls()
-            server.login(from_email, os.getenv('EMAIL_PASSWORD'))
+        password = os.getenv('EMAIL_PASSWORD')
+        if password:
+            server.login(os.getenv('EMAIL_FROM'), password)
+        logging.info(f"Открыто SMTP соединение с {SMTP_HOST}:{SMTP_PORT}")
+        return server
+
+    # Живое соединение: проверяем NOOP, при ошибке или долгом простое переподключаемся
+    def _get_connection(self):
+        if self._server is not None:
+            if time.monotonic() - self._last_used < SMTP_IDLE_TIMEOUT:
+                try:
+                    if self._server.noop()[0] == 250:
+                        return self._server
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self._close()
+        self._server = self._connect()
+        return self._server
+
+    def _close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    # Отправка готовых писем по одному соединению с экспоненциальной паузой между попытками
+    def send_batch(self, messages):
+        results = []
+        with self._lock:
+            for from_email, recipients, message_bytes in messages:
+                started = time.perf_counter()
+                for attempt in range(1, SMTP_MAX_ATTEMPTS + 1):
+                    try:
+                        self._get_connection().sendmail(from_email, recipients, message_bytes)
+                        self._last_used = time.monotonic()
+                        results.append(None)
+                        metrics.inc('smtp_messages_total', result='sent')
+                        break
+                    except (smtplib.SMTPException, OSError) as e:
+                        logging.error(f"Попытка {attempt}: Ошибка отправки email: {e}")
+                        self._close()
+                        if is_permanent_smtp_error(e) or attempt == SMTP_MAX_ATTEMPTS:
+                            logging.error("Достигнуто максимальное количество попыток отправки email. Прерываем.")
+                            results.append(e)
+                            metrics.inc('smtp_messages_total', result='failed')
+                            break
+                        time.sleep(SMTP_BACKOFF_BASE * 2 ** (attempt - 1) + random.uniform(0, SMTP_BACKOFF_BASE))
+                metrics.observe('smtp_send_seconds', time.perf_counter() - started)
+        return results
+
+    def send(self, from_email, recipients, message_bytes):
+        error = self.send_batch([(from_email, recipients, message_bytes)])[0]
+        if error is not None:
+            raise error
+
+    # Постановка письма в очередь; письма, накопившиеся к моменту отправки, уходят одним пакетом
+    def enqueue(self, from_email, recipients, message_bytes):
+        future = Future()
+        self._queue.put(((from_email, recipients, message_bytes), future))
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_worker, daemon=True)
+                self._worker.start()
+        return future
+
+    def _run_worker(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if len(batch) > 1:
+                logging.info(f"Пакетная отправка писем: {len(batch)}")
+            try:
+                results = self.send_batch([message for message, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), error in zip(batch, results):
+                if error is None:
+                    future.set_result(True)
+                else:
+                    future.set_exception(error)
 
-            all_recipients = to_email + cc_emails
-            server.sendmail(from_email, all_recipients, msg.as_string())
-            server.quit()
+mail_delivery = MailDelivery()
 
-            logging.info('Email sent successfully with the embedded statistics table screenshot and attachment.')
-            break
+# Функция для отправки email с отчетом; возвращает True, если письмо отправлено
+def send_email(excel_file, statistics_image, subject, email_body):
+    try:
+        message = build_report_email(excel_file, statistics_image, subject, email_body)
+        mail_delivery.enqueue(*message).result()
+        logging.info('Email sent successfully with the embedded statistics table screenshot and attachment.')
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка отправки email: {e}")
+        return False
+
+# Архив заказов плановых рассылок по дням: ARCHIVE_DIR/kind=<вид>/date=<ГГГГ-ММ-ДД>/part-<ЧЧММСС>.<формат>
+class OrderArchive:
+    columns = ['run_at', 'code', 'store', 'pickup_point_id', 'planning_date', 'creation_date']
+
+    def __init__(self, directory, archive_format='parquet'):
+        if archive_format not in ('parquet', 'csv.gz'):
+            raise ValueError(f"Неизвестный формат архива: {archive_format}")
+        if archive_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+            logging.error("pyarrow не установлен: архив в parquet недоступен, установите pyarrow или задайте ARCHIVE_FORMAT=csv.gz")
+        self.directory = directory
+        self.format = archive_format
+
+    def append(self, kind, run_at, orders):
+        frame = pd.DataFrame(
+            [(int(run_at.timestamp() * 1000), order.code, order.store, order.pickup_point_id,
+              order.planning_date, order.creation_date) for order in orders],
+            columns=self.columns
+        )
+        partition = os.path.join(self.directory, f'kind={kind}', f"date={run_at.strftime('%Y-%m-%d')}")
+        os.makedirs(partition, exist_ok=True)
+        path = os.path.join(partition, f"part-{run_at.strftime('%H%M%S')}.{self.format}")
+        if self.format == 'parquet':
+            frame.to_parquet(path, index=False)
+        else:
+            frame.to_csv(path, index=False, compression='gzip')
+        return path
+
+order_archive = OrderArchive(ARCHIVE_DIR, ARCHIVE_FORMAT)
+
+# Сохранение результата плановой рассылки: заказы в архив, количество по магазинам — в дневные итоги.
+# Ошибка архива не должна мешать отправке отчета
+def archive_report_run(kind, order_set, orders_by_store, run_at=None):
+    try:
+        run_at = run_at or datetime.now(UTC_PLUS_5)
+        selected_codes = {code for codes in orders_by_store.values() for code in codes}
+        orders = [order for order in order_set if order.code in selected_codes]
+        path = order_archive.append(kind, run_at, orders)
+        counts_by_store = count_by_store(orders_by_store)
+        counts_by_store['Итого'] = sum(counts_by_store.values())
+        get_order_store().replace_daily_stats(run_at.strftime('%Y-%m-%d'), kind, counts_by_store)
+        logging.info(f"Заказы рассылки {kind} сохранены в архив: {path}")
+    except Exception as e:
+        logging.error(f"Не удалось сохранить заказы рассылки {kind} в архив: {e}")
+
+# Дневные итоги по магазинам за период: таблица день × магазин; дни без рассылки пустые
+def load_store_trends(kind, days, today=None):
+    today = (today or datetime.now(UTC_PLUS_5)).date()
+    first_day = today - timedelta(days=days - 1)
+    rows = get_order_store().load_daily_stats(kind, first_day.isoformat())
+    index = pd.Index([(first_day + timedelta(days=offset)).isoformat() for offset in range(days)], name='day')
+    if not rows:
+        return pd.DataFrame(index=index)
+    trends = pd.DataFrame(rows, columns=['day', 'store', 'orders']).pivot(index='day', columns='store', values='orders')
+    # В дни с рассылкой магазин без заказов — это ноль, а не пропуск
+    run_days = trends['Итого'].notna() if 'Итого' in trends else trends.notna().any(axis=1)
+    trends.loc[run_days] = trends.loc[run_days].fillna(0)
+    return trends.reindex(index)
+
+STATS_TITLES = {
+    'overdue': 'Просроченные заказы',
+    'pending': 'Заказы, ожидающие передачи',
+}
 
-        except (smtplib.SMTPException, ConnectionResetError) as e:
-            logging.error(f"Попытка {attempt}: Ошибка отправки email: {e}")
-            if attempt == max_attempts:
-                logging.error("Достигнуто максимальное количество попыток отправки email. Прерываем.")
-                break
-            attempt += 1
-            time.sleep(10)
+# График динамики по магазинам (по одному на вид отчета) в PNG
+def create_trends_chart(trends_by_kind):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(11, 4.5 * len(trends_by_kind)))
+    FigureCanvasAgg(fig)
+    for position, (kind, trends) in enumerate(trends_by_kind.items(), start=1):
+        ax = fig.add_subplot(len(trends_by_kind), 1, position)
+        ax.set_title(STATS_TITLES.get(kind, kind))
+        stores = [store for store in trends.columns if store != 'Итого']
+        # Дни без рассылки пропускаются, линия соединяет соседние рассылки
+        for store in stores:
+            series = trends[store].dropna()
+            ax.plot([datetime.strptime(day, '%Y-%m-%d') for day in series.index], series.values,
+                    marker='.', linewidth=1.2, label=store)
+        ax.grid(True, alpha=0.3)
+        ax.set_ylabel('Заказов')
+        if stores:
+            ax.legend(loc='upper left', bbox_to_anchor=(1.01, 1), fontsize=8)
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    chart = BytesIO()
+    chart.name = f"stats_{datetime.now(UTC_PLUS_5).strftime('%Y%m%d_%H%M%S')}.png"
+    fig.savefig(chart, format='png', dpi=100)
+    chart.seek(0)
+    return chart
+
+# Разбор аргументов /stats: число дней и (необязательно) вид отчета
+def parse_stats_args(args):
+    days = STATS_DEFAULT_DAYS
+    kinds = list(STATS_TITLES)
+    for arg in args:
+        if arg.isdigit():
+            days = min(max(int(arg), 1), STATS_MAX_DAYS)
+        elif arg in STATS_TITLES:
+            kinds = [arg]
+        else:
+            raise ValueError(f"Неизвестный параметр {arg}. Пример: /stats 60 overdue")
+    return days, kinds
+
+# Строки сводки: по каждому магазину сумма за период и число дней с заказами, по убыванию
+def iter_trend_summary_lines(kind, trends, days):
+    yield f'📈 {STATS_TITLES.get(kind, kind)} за {days} дн.:'
+    stores = [store for store in trends.columns if store != 'Итого']
+    run_days = int(trends['Итого'].notna().sum()) if 'Итого' in trends else 0
+    if not stores or not run_days:
+        yield 'Нет данных в архиве за этот период.'
+        return
+    yield f"Итого в среднем за день: {trends['Итого'].mean():.1f}"
+    totals = trends[stores].sum().sort_values(ascending=False)
+    for store, total in totals.items():
+        yield f'{store}: {int(total)} заказов, дней с заказами: {int((trends[store] > 0).sum())} из {run_days}'
+
+# Ответ на /stats: график и сводка из дневных итогов, без запросов к Kaspi
+def build_stats_reply(args):
+    days, kinds = parse_stats_args(args)
+    trends_by_kind = {kind: load_store_trends(kind, days) for kind in kinds}
+    lines = []
+    for kind, trends in trends_by_kind.items():
+        if lines:
+            lines.append('')
+        lines.extend(iter_trend_summary_lines(kind, trends, days))
+    return create_trends_chart(trends_by_kind), lines
+
+# Снимок для ответов по индексам: последний в памяти, выгрузка — только если он старше ORDER_INDEX_MAX_AGE
+def get_indexed_snapshot():
+    order_set = order_snapshot_cache.fresh(get_snapshot_key(), ORDER_INDEX_MAX_AGE)
+    if order_set is not None:
+        return order_set
+    return get_order_snapshot()
+
+# Аргументы команды одной строкой: "/orders Almaty Mart" -> "Almaty Mart"
+def get_command_args(text):
+    parts = (text or '').split(maxsplit=1)
+    return parts[1].strip() if len(parts) > 1 else ''
+
+# Магазины по запросу: код точки (полный или после "_"), название или часть названия
+def resolve_store(query):
+    query = query.strip().lower()
+    stores = {code: name for code, name in store_mapping.items() if code != 'Итого'}
+    exact = {
+        name for code, name in stores.items()
+        if query in (code.lower(), code.rsplit('_', 1)[-1].lower(), name.lower())
+    }
+    if exact:
+        return sorted(exact)
+    return sorted({name for name in stores.values() if query in name.lower()})
+
+# Ответ, если магазин не найден или запрос подходит нескольким магазинам
+def format_store_choice(query, matches):
+    if matches:
+        return [f'Под «{query}» подходят несколько магазинов, уточните:'] + [f'  🔸 {name}' for name in matches]
+    names = sorted({name for code, name in store_mapping.items() if code != 'Итого'})
+    return [f'❌ Магазин «{query}» не найден. Доступные магазины:'] + [f'  🔸 {name}' for name in names]
+
+# Заголовок и текст при отсутствии заказов для списков одного магазина
+STORE_VIEW_TITLES = {
+    'overdue': ('📦 Задержанные заказы магазина {store}:', '❌ Нет просроченных заказов магазина {store}.'),
+    'pending': ('📦 Заказы магазина {store}, ожидающие передачи курьеру:',
+                '❌ Нет заказов магазина {store}, ожидающих передачи курьеру.'),
+}
 
-        finally:
-            if screenshot_filename and os.path.exists(screenshot_filename):
-                try:
-                    os.remove(screenshot_filename)
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении файла {screenshot_filename}: {e}")
-            if os.path.exists(file_name):
-                try:
-                    os.remove(file_name)
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении файла {file_name}: {e}")
+# Список просроченных (overdue) или ожидающих (pending) заказов одного магазина из индексов снимка
+def build_store_lines(order_set, kind, store):
+    orders = getattr(order_set.index, kind)(store)
+    title, empty_text = STORE_VIEW_TITLES[kind]
+    if not orders:
+        return [empty_text.format(store=store), format_snapshot_age(order_set)]
+    lines = [title.format(store=store), '']
+    for order in orders:
+        planned = f"{from_epoch_ms(order.planning_date):%d.%m %H:%M}" if order.planning_date else 'без даты'
+        lines.append(f'  🔸 Номер заказа: {order.code}, передача {planned}')
+    lines.append('')
+    lines.append(f'Всего: {len(orders)}')
+    lines.append(format_snapshot_age(order_set))
+    return lines
+
+# Ответ /orders <магазин> и /pending_orders <магазин>
+def build_store_reply(order_set, kind, query):
+    matches = resolve_store(query)
+    if len(matches) != 1:
+        return format_store_choice(query, matches)
+    return build_store_lines(order_set, kind, matches[0])
+
+# Ответ /order <номер>: магазин, даты и состояние заказа по последнему снимку
+def build_order_reply(order_set, code):
+    if not code:
+        return ['Укажите номер заказа: /order <номер>']
+    order = order_set.index.get(code)
+    if order is None:
+        return [
+            f'❌ Заказ {code} не найден среди принятых заказов Kaspi Delivery за {ORDER_LOOKBACK_DAYS} дней.',
+            format_snapshot_age(order_set),
+        ]
+
+    now = datetime.now(UTC_PLUS_5)
+    if order.transmission_date:
+        state = f'✅ Передан курьеру {from_epoch_ms(order.transmission_date):%d.%m %H:%M}'
+    elif any(classify_overdue([order], now)):
+        state = '⏰ Просрочен: не передан курьеру'
+    elif any(classify_pending([order], now)):
+        state = '🕒 Ожидает передачи курьеру сегодня'
+    else:
+        state = '🕒 Ожидает передачи курьеру'
+    lines = [f'📦 Заказ {order.code}', f'Магазин: {order.store}']
+    if order.creation_date:
+        lines.append(f'Создан: {from_epoch_ms(order.creation_date):%d.%m %H:%M}')
+    if order.planning_date:
+        lines.append(f'Плановая передача: {from_epoch_ms(order.planning_date):%d.%m %H:%M}')
+    lines.append(state)
+    lines.append(format_snapshot_age(order_set))
+    return lines
+
+# Ответ /subscribe и /unsubscribe; без аргумента — список подписок чата
+def build_subscription_reply(chat_id, query, subscribe=True):
+    store_db = get_order_store()
+    if not query:
+        stores = store_db.chat_subscriptions(chat_id)
+        if not stores:
+            return ['Подписок нет. Подписаться на магазин: /subscribe <магазин>']
+        return ['Подписки чата:'] + [f'  🔸 {store}' for store in stores]
+
+    matches = resolve_store(query)
+    if len(matches) != 1:
+        return format_store_choice(query, matches)
+    store = matches[0]
+    if subscribe:
+        store_db.subscribe(chat_id, store)
+        return [f'✅ Чат подписан на магазин {store}: списки заказов при плановых рассылках и оповещения о просрочке.']
+    if store_db.unsubscribe(chat_id, store):
+        return [f'✅ Подписка на магазин {store} отменена.']
+    return [f'Чат не подписан на магазин {store}.']
+
+# Списки заказов магазинов для подписчиков после плановой рассылки: пары (чат, шаги ответа)
+def iter_subscriber_messages(kind, order_set):
+    try:
+        subscribers = get_order_store().store_subscribers()
+    except Exception as e:
+        logging.error(f"Не удалось загрузить подписки на магазины: {e}")
+        return
+    file_name = get_report_file_name(REPORT_KINDS[kind][1], 'txt')
+    for store, chat_ids in subscribers.items():
+        lines = build_store_lines(order_set, kind, store)
+        for chat_id in chat_ids:
+            yield chat_id, iter_message_parts(lines, MESSAGE_FILE_THRESHOLD, file_name)
+
+def notify_store_subscribers(kind, order_set):
+    for chat_id, steps in iter_subscriber_messages(kind, order_set):
+        try:
+            send_reply_steps(chat_id, steps)
+        except Exception as e:
+            logging.error(f"Не удалось отправить список заказов подписчику {chat_id}: {e}")
+
+# Заголовки списка заказов и статистики для /orders и /pending_orders
+ORDER_LIST_TITLES = {
+    'overdue': ('📦 Задержанные заказы по магазинам:', '📊 Статистика по задержанным заказам:'),
+    'pending': ('📦 Заказы, ожидающие передачи курьеру, по магазинам:', '📊 Статистика по заказам, ожидающим передачи:'),
+}
+
+# Шаги ответа списком заказов для обоих рантаймов: ('status', текст статуса), ('message', текст),
+# ('document', файл), ('photo', картинка). Excel и скриншот строятся, когда запрошен следующий шаг
+def iter_orders_reply(kind, orders_by_store, order_set=None):
+    _, sheet_name, _, _, empty_text = REPORT_KINDS[kind]
+    if not orders_by_store:
+        yield 'status', empty_text
+        return
+
+    title, statistics_title = ORDER_LIST_TITLES[kind]
+    counts_by_store = count_by_store(orders_by_store)
+    selected_count = sum(counts_by_store.values())
+    yield from iter_message_parts(iter_order_lines(title, orders_by_store), MESSAGE_FILE_THRESHOLD,
+                                  get_report_file_name(sheet_name, 'txt'), selected_count)
+
+    statistics_lines = list(iter_statistics_lines(statistics_title, counts_by_store))
+    if order_set is not None:
+        statistics_lines.append(format_snapshot_age(order_set))
+    yield from iter_message_parts(statistics_lines)
+
+    yield 'status', '📄 Формирование Excel файла...'
+    yield 'document', create_report_file(orders_by_store, sheet_name=sheet_name)
+
+    yield 'status', '🖼 Построение таблицы статистики...'
+    yield 'photo', create_statistics_screenshot(counts_by_store)
+    yield 'status', f'✅ Готово: {selected_count} заказов.'
+
+# Ответ в чат списком заказов, статистикой, Excel и скриншотом.
+# Заказы классифицируются потоком по мере прихода страниц (статус показывает прогресс),
+# в памяти остаются только отобранные номера, сгруппированные по магазинам
+def reply_with_orders(chat_id, orders, kind, status):
+    orders_by_store = group_by_store(orders)
+    order_set = order_snapshot_cache.latest(get_snapshot_key())
+    send_reply_steps(chat_id, iter_orders_reply(kind, orders_by_store, order_set), status)
 
 # Обработка команды /orders
 @bot.message_handler(commands=['orders'])
 def fetch_orders(message):
     try:
-        bot.send_message(message.chat.id, '🔄 Получение списка просроченных заказов...')
-
-        overdue_orders_by_store = get_overdue_orders()
-        
-        if not overdue_orders_by_store:
-            bot.send_message(message.chat.id, '❌ Нет просроченных заказов за указанный период.')
+        query = get_command_args(message.text)
+        if query:
+            send_message_lines(message.chat.id, build_store_reply(get_indexed_snapshot(), 'overdue', query),
+                               file_threshold=MESSAGE_FILE_THRESHOLD, file_name=get_report_file_name("Overdue Orders", 'txt'))
             return
 
-        response_text_orders = f'📦 Задержанные заказы по магазинам:\n\n'
-        for store, orders in overdue_orders_by_store.items():
-            response_text_orders += f'Магазин {store}:\n'
-            for order_code in orders:
-                response_text_orders += f'  🔸 Номер заказа: {order_code}\n'
-
-        send_long_message(message.chat.id, response_text_orders)
+        status = StatusMessage(message.chat.id, '🔄 Получение списка просроченных заказов...')
 
-        response_text_count = '📊 Статистика по задержанным заказам:\n\n'
-        total_orders = 0
-        for store, orders in overdue_orders_by_store.items():
-            response_text_count += f'{store}: {len(orders)} заказов\n'
-            total_orders += len(orders)
+        reply_with_orders(
+            message.chat.id,
+            classify_overdue(track_progress(iter_order_snapshot(), status, '🔄 Получение списка просроченных заказов...')),
+            'overdue',
+            status=status
+        )
 
-        response_text_count += f'\n✅ Итого: {total_orders} заказов'
-        send_long_message(message.chat.id, response_text_count)
+    except Exception as e:
+        logging.error(f"Ошибка при обработке заказов: {e}")
+        bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
-        file_name = create_excel(overdue_orders_by_store, sheet_name="Overdue Orders")
-        
-        with open(file_name, 'rb') as file:
-            bot.send_document(message.chat.id, file)
+# Обработка команды /pending_orders
+@bot.message_handler(commands=['pending_orders'])
+def fetch_pending_orders(message):
+    try:
+        query = get_command_args(message.text)
+        if query:
+            send_message_lines(message.chat.id, build_store_reply(get_indexed_snapshot(), 'pending', query),
+                               file_threshold=MESSAGE_FILE_THRESHOLD, file_name=get_report_file_name("Pending Orders", 'txt'))
+            return
 
-        screenshot_filename = create_statistics_screenshot(file_name)
-        
-        with open(screenshot_filename, 'rb') as img_file:
-            bot.send_photo(message.chat.id, img_file)
+        status = StatusMessage(message.chat.id, '🔄 Получение списка заказов, ожидающих передачи курьеру...')
 
-        os.remove(file_name)
-        os.remove(screenshot_filename)
+        reply_with_orders(
+            message.chat.id,
+            classify_pending(track_progress(iter_order_snapshot(), status, '🔄 Получение списка заказов, ожидающих передачи курьеру...')),
+            'pending',
+            status=status
+        )
 
     except Exception as e:
         logging.error(f"Ошибка при обработке заказов: {e}")
         bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
-# Обработка команды /pending_orders
-@bot.message_handler(commands=['pending_orders'])
-def fetch_pending_orders(message):
+# Обработка команды /refresh: принудительное обновление снимка заказов
+@bot.message_handler(commands=['refresh'])
+def refresh_orders(message):
     try:
-        bot.send_message(message.chat.id, '🔄 Получение списка заказов, ожидающих передачи курьеру...')
+        bot.send_message(message.chat.id, '🔄 Обновление данных заказов из Kaspi...')
+        order_set = get_order_snapshot(force_refresh=True, allow_stale=False)
 
-        pending_orders_by_store = get_pending_orders()
-        
-        if not pending_orders_by_store:
-            bot.send_message(message.chat.id, '❌ Нет заказов, ожидающих передачи курьеру за указанный период.')
+        if order_set is None:
+            bot.send_message(message.chat.id, '❌ Не удалось получить данные из Kaspi.')
             return
 
-        response_text_orders = f'📦 Заказы, ожидающие передачи курьеру, по магазинам:\n\n'
-        for store, orders in pending_orders_by_store.items():
-            response_text_orders += f'Магазин {store}:\n'
-            for order_code in orders:
-                response_text_orders += f'  🔸 Номер заказа: {order_code}\n'
+        bot.send_message(message.chat.id, format_refresh_reply(order_set))
 
-        send_long_message(message.chat.id, response_text_orders)
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении данных заказов: {e}")
+        bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
-        response_text_count = '📊 Статистика по заказам, ожидающим передачи:\n\n'
-        total_orders = 0
-        for store, orders in pending_orders_by_store.items():
-            response_text_count += f'{store}: {len(orders)} заказов\n'
-            total_orders += len(orders)
+# Обработка команды /stats [дней] [overdue|pending]
+@bot.message_handler(commands=['stats'])
+def send_stats(message):
+    try:
+        chart, lines = build_stats_reply(message.text.split()[1:])
+        telegram_pacer.call(bot.send_photo, message.chat.id, chart)
+        send_message_lines(message.chat.id, lines)
 
-        response_text_count += f'\n✅ Итого: {total_orders} заказов'
-        send_long_message(message.chat.id, response_text_count)
+    except Exception as e:
+        logging.error(f"Ошибка при построении статистики: {e}")
+        bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
-        file_name = create_excel(pending_orders_by_store, sheet_name="Pending Orders")
-        
-        with open(file_name, 'rb') as file:
-            bot.send_document(message.chat.id, file)
+# Обработка команды /order <номер>
+@bot.message_handler(commands=['order'])
+def send_order_status(message):
+    try:
+        send_message_lines(message.chat.id, build_order_reply(get_indexed_snapshot(), get_command_args(message.text)))
 
-        screenshot_filename = create_statistics_screenshot(file_name)
-        
-        with open(screenshot_filename, 'rb') as img_file:
-            bot.send_photo(message.chat.id, img_file)
+    except Exception as e:
+        logging.error(f"Ошибка при поиске заказа: {e}")
+        bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
-        os.remove(file_name)
-        os.remove(screenshot_filename)
+# Обработка команд /subscribe <магазин> и /unsubscribe <магазин>
+@bot.message_handler(commands=['subscribe', 'unsubscribe'])
+def change_subscription(message):
+    try:
+        subscribe = not message.text.startswith('/unsubscribe')
+        send_message_lines(
+            message.chat.id, build_subscription_reply(message.chat.id, get_command_args(message.text), subscribe)
+        )
 
     except Exception as e:
-        logging.error(f"Ошибка при обработке заказов: {e}")
+        logging.error(f"Ошибка при изменении подписки: {e}")
         bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
+# Тексты писем с отчетами
+OVERDUE_EMAIL_BODY = (
+    "Good evening, There are delayed orders that were supposed to be handed over to the courier today. "
+    "Please find these orders.\n\n"
+    "Қайырлы кеш, Төменде кешіккен тапсырыс саны."
+)
+PENDING_EMAIL_BODY = (
+    "Қайырлы таң, Төменде бүгін курьерге жіберілуі керек тапсырыс саны.\n\n"
+    "Good morning, Attached are all the pending orders for courier handover today."
+)
+
 # Обработка команды /send_report
 @bot.message_handler(commands=['send_report'])
 def send_report(message):
     try:
-        bot.send_message(message.chat.id, '🔄 Запуск отчета по просроченным заказам...')
+        status = StatusMessage(message.chat.id, '🔄 Запуск отчета по просроченным заказам...')
 
         overdue_orders_by_store = get_overdue_orders()
         
         if not overdue_orders_by_store:
-            bot.send_message(message.chat.id, '❌ Нет просроченных заказов за указанный период.')
+            status.update('❌ Нет просроченных заказов за указанный период.', force=True)
             return
 
-        file_name = create_excel(overdue_orders_by_store, sheet_name="Overdue Orders")
-        email_body = (
-            "Good evening, There are delayed orders that were supposed to be handed over to the courier today. "
-            "Please find these orders.\n\n"
-            "Қайырлы кеш, Төменде кешіккен тапсырыс саны."
-        )
-        send_email(file_name, subject="Delayed orders OMS", email_body=email_body)
+        status.update('📄 Формирование Excel файла...', force=True)
+        excel_file = create_report_file(overdue_orders_by_store, sheet_name="Overdue Orders")
+        statistics_image = create_statistics_screenshot(count_by_store(overdue_orders_by_store))
+        email_body = OVERDUE_EMAIL_BODY
+        status.update('✉️ Отправка отчета по электронной почте...', force=True)
+        if not send_email(excel_file, statistics_image, subject="Delayed orders OMS", email_body=email_body):
+            status.update('❌ Не удалось отправить отчет по электронной почте.', force=True)
+            return
 
-        bot.send_message(message.chat.id, '✅ Отчет успешно отправлен по электронной почте.')
+        status.update('✅ Отчет успешно отправлен по электронной почте.', force=True)
 
     except Exception as e:
         logging.error(f"Ошибка при отправке отчета вручную: {e}")
@@ -501,86 +2625,873 @@ def send_report(message):
 @bot.message_handler(commands=['send_pending_report'])
 def send_pending_report(message):
     try:
-        bot.send_message(message.chat.id, '🔄 Запуск отчета по заказам, ожидающим передачи курьеру...')
+        status = StatusMessage(message.chat.id, '🔄 Запуск отчета по заказам, ожидающим передачи курьеру...')
 
         pending_orders_by_store = get_pending_orders()
         
         if not pending_orders_by_store:
-            bot.send_message(message.chat.id, '❌ Нет заказов, ожидающих передачи курьеру за указанный период.')
+            status.update('❌ Нет заказов, ожидающих передачи курьеру за указанный период.', force=True)
             return
 
-        file_name = create_excel(pending_orders_by_store, sheet_name="Pending Orders")
-        email_body = (
-            "Қайырлы таң, Төменде бүгін курьерге жіберілуі керек тапсырыс саны.\n\n"
-            "Good morning, Attached are all the pending orders for courier handover today."
-        )
-        send_email(file_name, subject="Pending orders OMS", email_body=email_body)
+        status.update('📄 Формирование Excel файла...', force=True)
+        excel_file = create_report_file(pending_orders_by_store, sheet_name="Pending Orders")
+        statistics_image = create_statistics_screenshot(count_by_store(pending_orders_by_store))
+        email_body = PENDING_EMAIL_BODY
+        status.update('✉️ Отправка отчета по электронной почте...', force=True)
+        if not send_email(excel_file, statistics_image, subject="Pending orders OMS", email_body=email_body):
+            status.update('❌ Не удалось отправить отчет по электронной почте.', force=True)
+            return
 
-        bot.send_message(message.chat.id, '✅ Отчет успешно отправлен по электронной почте.')
+        status.update('✅ Отчет успешно отправлен по электронной почте.', force=True)
 
     except Exception as e:
         logging.error(f"Ошибка при отправке отчета вручную: {e}")
         bot.send_message(message.chat.id, f'Произошла ошибка: {e}')
 
+# Время авторассылок по UTC+5
+JOB_OVERDUE_AT = os.getenv('JOB_OVERDUE_AT', '18:00')
+JOB_PENDING_AT = os.getenv('JOB_PENDING_AT', '10:00')
+# За сколько минут до рассылки выгружать заказы (0 — выгружать в момент отправки)
+JOB_PREFETCH_MINUTES = float(os.getenv('JOB_PREFETCH_MINUTES', '3'))
+# На сколько часов можно опоздать с рассылкой, пропущенной из-за перезапуска
+JOB_CATCH_UP_HOURS = float(os.getenv('JOB_CATCH_UP_HOURS', '6'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+SCHEDULER_HEARTBEAT_INTERVAL = 30
+
+# Состояние фоновых задач для /healthz: последний цикл планировщика и итог каждой задачи
+SCHEDULER_STALE_AFTER = float(os.getenv('SCHEDULER_STALE_AFTER', '120'))
+scheduler_state = {'heartbeat': None}
+job_status = {}
+
+# Итог задачи по расписанию: sent, empty или failed
+def record_job_run(name, started_at, result):
+    elapsed = time.perf_counter() - started_at
+    metrics.observe('job_seconds', elapsed, job=name)
+    metrics.inc('job_runs_total', job=name, result=result)
+    metrics.set('job_last_run_timestamp_seconds', int(time.time()), job=name)
+    job_status[name] = {
+        'result': result,
+        'seconds': round(elapsed, 3),
+        'finished_at': datetime.now(timezone.utc).isoformat(),
+    }
+    if BOT_MULTIPROCESS:
+        share_job_state(f'job_status:{name}', job_status[name])
+
+# Состояние планировщика видно всем процессам: /healthz может попасть в любой воркер
+def share_job_state(key, value):
+    try:
+        get_order_store().set_shared(key, value)
+    except Exception as e:
+        logging.error(f"Не удалось сохранить общее состояние {key}: {e}")
+
+# Состояние бота: планировщик жив, если отметился недавно; неудачная задача не делает бота нездоровым
+def get_health():
+    heartbeat = scheduler_state['heartbeat']
+    next_runs = dict(scheduler_state.get('next_runs', {}))
+    jobs = dict(job_status)
+    if BOT_MULTIPROCESS:
+        store = get_order_store()
+        heartbeat = store.get_shared('scheduler_heartbeat')
+        next_runs = store.get_shared('scheduler_next_runs') or {}
+        jobs = store.get_shared_prefix('job_status:')
+    heartbeat_age = time.time() - heartbeat if heartbeat is not None else None
+    scheduler_alive = heartbeat_age is not None and heartbeat_age < SCHEDULER_STALE_AFTER
+    if not scheduler_alive:
+        status = 'down'
+    elif any(job['result'] == 'failed' for job in jobs.values()):
+        status = 'degraded'
+    else:
+        status = 'ok'
+    return {
+        'status': status,
+        'scheduler': {
+            'alive': scheduler_alive,
+            'heartbeat_age': round(heartbeat_age, 1) if heartbeat_age is not None else None,
+            'next_runs': next_runs,
+        },
+        'jobs': jobs,
+        'merchants': {
+            merchant.name: {'circuit_open': merchant.circuit.is_open()} for merchant in merchants
+        },
+    }
+
 # Авторассылка в 6 вечера для просроченных заказов с обработкой ошибок
-def job_overdue():
+# (order_set — снимок, заранее выгруженный планировщиком)
+def job_overdue(order_set=None):
+    started_at = time.perf_counter()
+    result = 'failed'
     try:
         logging.info("Запуск автоотправки отчета по просроченным заказам...")
-        overdue_orders_by_store = get_overdue_orders()
+        if order_set is None:
+            order_set = get_order_snapshot(allow_stale=False)
+        overdue_orders_by_store = get_overdue_orders(order_set)
+        archive_report_run('overdue', order_set, overdue_orders_by_store)
+        notify_store_subscribers('overdue', order_set)
         
         if not overdue_orders_by_store:
             logging.info("Нет просроченных заказов для автоотправки.")
+            result = 'empty'
             return
 
-        file_name = create_excel(overdue_orders_by_store, sheet_name="Overdue Orders")
-        email_body = (
-            "Good evening, There are delayed orders that were supposed to be handed over to the courier today. "
-            "Please find these orders.\n\n"
-            "Қайырлы кеш, Төменде кешіккен тапсырыс саны."
-        )
-        send_email(file_name, subject="Delayed orders OMS", email_body=email_body)
+        excel_file = create_report_file(overdue_orders_by_store, sheet_name="Overdue Orders")
+        statistics_image = create_statistics_screenshot(count_by_store(overdue_orders_by_store))
+        email_body = OVERDUE_EMAIL_BODY
+        if send_email(excel_file, statistics_image, subject="Delayed orders OMS", email_body=email_body):
+            result = 'sent'
         logging.info("Автоотправка отчета по просроченным заказам завершена.")
 
     except Exception as e:
         logging.error(f"Ошибка при автоотправке отчета по просроченным заказам: {e}")
+    finally:
+        record_job_run('overdue', started_at, result)
 
 # Авторассылка в 10 утра для заказов, ожидающих передачи с обработкой ошибок
-def job_pending():
+def job_pending(order_set=None):
+    started_at = time.perf_counter()
+    result = 'failed'
     try:
         logging.info("Запуск автоотправки отчета по ожидающим заказам...")
-        pending_orders_by_store = get_pending_orders()
+        if order_set is None:
+            order_set = get_order_snapshot(allow_stale=False)
+        pending_orders_by_store = get_pending_orders(order_set)
+        archive_report_run('pending', order_set, pending_orders_by_store)
+        notify_store_subscribers('pending', order_set)
         
         if not pending_orders_by_store:
             logging.info("Нет заказов, ожидающих передачи, для автоотправки.")
+            result = 'empty'
             return
 
-        file_name = create_excel(pending_orders_by_store, sheet_name="Pending Orders")
-        email_body = (
-            "Қайырлы таң, Төменде бүгін курьерге жіберілуі керек тапсырыс саны.\n\n"
-            "Good morning, Attached are all the pending orders for courier handover today."
-        )
-        send_email(file_name, subject="Pending orders OMS", email_body=email_body)
+        excel_file = create_report_file(pending_orders_by_store, sheet_name="Pending Orders")
+        statistics_image = create_statistics_screenshot(count_by_store(pending_orders_by_store))
+        email_body = PENDING_EMAIL_BODY
+        if send_email(excel_file, statistics_image, subject="Pending orders OMS", email_body=email_body):
+            result = 'sent'
         logging.info("Автоотправка отчета по ожидающим заказам завершена.")
 
     except Exception as e:
         logging.error(f"Ошибка при автоотправке отчета по ожидающим заказам: {e}")
+    finally:
+        record_job_run('pending', started_at, result)
+
+# Время следующего запуска ежедневной задачи "HH:MM" по UTC+5
+def get_next_run_time(at_time, now=None):
+    now = now or datetime.now(UTC_PLUS_5)
+    hour, minute = map(int, at_time.split(':'))
+    run_at = now.astimezone(UTC_PLUS_5).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return run_at
+
+# Время последнего запуска по расписанию, не позже now
+def get_previous_run_time(at_time, now=None):
+    now = now or datetime.now(UTC_PLUS_5)
+    return get_next_run_time(at_time, now) - timedelta(days=1)
+
+# Ежедневная задача: время по UTC+5, функция отправки и (необязательно) заранее выгружаемый снимок заказов
+class DailyJob:
+    def __init__(self, name, at_time, run, prefetch=None):
+        self.name = name
+        self.at_time = at_time
+        self.run = run
+        self.prefetch = prefetch
+        self.run_at = None
+        self.prefetch_at = None
+        self.prefetched = None
+        self.lock = threading.Lock()
+
+# Планировщик: поток спит до ближайшего срока, задачи выполняются в пуле потоков.
+# Одна и та же задача не запускается повторно, пока не закончилась; запуски, пропущенные
+# из-за перезапуска, выполняются при старте, если опоздание не больше JOB_CATCH_UP_HOURS
+class JobScheduler:
+    def __init__(self, jobs, workers=None):
+        self.jobs = jobs
+        self._executor = ThreadPoolExecutor(max_workers=workers or JOB_WORKERS, thread_name_prefix='job')
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        now = datetime.now(UTC_PLUS_5)
+        for job in self.jobs:
+            self._schedule_next(job, now)
+        self._catch_up(now)
+        self._thread = threading.Thread(target=self._run_loop, name='scheduler', daemon=True)
+        self._thread.start()
+        logging.info("Планировщик запущен: " + ', '.join(
+            f"{job.name} в {job.run_at.strftime('%Y-%m-%d %H:%M')}" for job in self.jobs
+        ))
+
+    def _schedule_next(self, job, now):
+        job.run_at = get_next_run_time(job.at_time, now)
+        prefetch_at = job.run_at - timedelta(minutes=JOB_PREFETCH_MINUTES)
+        job.prefetch_at = prefetch_at if job.prefetch is not None and JOB_PREFETCH_MINUTES > 0 and prefetch_at > now else None
+        scheduler_state.setdefault('next_runs', {})[job.name] = job.run_at.isoformat()
+
+    # Запуски, которые должны были пройти, пока бот был остановлен
+    def _catch_up(self, now):
+        try:
+            store = get_order_store()
+        except Exception as e:
+            logging.error(f"Не удалось проверить пропущенные запуски: {e}")
+            return
+        for job in self.jobs:
+            last_run_ms = store.get_state(f'job_last_run:{job.name}')
+            scheduled_at = get_previous_run_time(job.at_time, now)
+            if last_run_ms is None:
+                # Первый запуск с этой базой: отметка появится после ближайшей рассылки
+                continue
+            if last_run_ms >= int(scheduled_at.timestamp() * 1000):
+                continue
+            if now - scheduled_at > timedelta(hours=JOB_CATCH_UP_HOURS):
+                logging.warning(f"Пропущен запуск {job.name} в {scheduled_at:%Y-%m-%d %H:%M}, догонять уже поздно")
+                continue
+            logging.warning(f"Выполняется пропущенный запуск {job.name} за {scheduled_at:%Y-%m-%d %H:%M}")
+            self._submit(job, scheduled_at)
+
+    def _run_loop(self):
+        while True:
+            try:
+                scheduler_state['heartbeat'] = time.time()
+                if BOT_MULTIPROCESS:
+                    share_job_state('scheduler_heartbeat', scheduler_state['heartbeat'])
+                    share_job_state('scheduler_next_runs', scheduler_state.get('next_runs', {}))
+                now = datetime.now(UTC_PLUS_5)
+                for job in self.jobs:
+                    if job.prefetch_at is not None and now >= job.prefetch_at:
+                        job.prefetch_at = None
+                        self._executor.submit(self._prefetch, job)
+                    if now >= job.run_at:
+                        scheduled_at = job.run_at
+                        self._schedule_next(job, now)
+                        self._submit(job, scheduled_at)
+
+                deadline = min(
+                    moment for job in self.jobs for moment in (job.run_at, job.prefetch_at) if moment is not None
+                )
+                # Просыпаемся к сроку, но не реже раза в SCHEDULER_HEARTBEAT_INTERVAL — для /healthz
+                self._wakeup.wait(min(max((deadline - now).total_seconds(), 0), SCHEDULER_HEARTBEAT_INTERVAL))
+                self._wakeup.clear()
+            except Exception as e:
+                logging.error(f"Ошибка в планировщике: {e}")
+                time.sleep(15)
+
+    def _prefetch(self, job):
+        try:
+            started = time.perf_counter()
+            job.prefetched = job.prefetch()
+            logging.info(f"Заказы для {job.name} выгружены заранее за {time.perf_counter() - started:.1f} сек.")
+        except Exception as e:
+            job.prefetched = None
+            logging.error(f"Не удалось заранее выгрузить заказы для {job.name}: {e}")
+
+    def _submit(self, job, scheduled_at):
+        if not job.lock.acquire(blocking=False):
+            logging.warning(f"Задача {job.name} еще выполняется, запуск за {scheduled_at:%H:%M} пропущен")
+            metrics.inc('job_runs_total', job=job.name, result='skipped')
+            job.prefetched = None
+            return
+        # Ведущий процесс мог смениться: запуск за это плановое время выполняется только один раз
+        if BOT_MULTIPROCESS and not self._claim(job, scheduled_at):
+            logging.info(f"Запуск {job.name} за {scheduled_at:%Y-%m-%d %H:%M} уже выполнен другим процессом")
+            job.lock.release()
+            job.prefetched = None
+            return
+        self._executor.submit(self._execute, job, scheduled_at)
+
+    def _claim(self, job, scheduled_at):
+        try:
+            return get_order_store().claim_job_run(
+                job.name, int(scheduled_at.timestamp() * 1000), int(time.time() * 1000)
+            )
+        except Exception as e:
+            logging.error(f"Не удалось закрепить запуск {job.name}: {e}")
+            return False
+
+    def _execute(self, job, scheduled_at):
+        try:
+            order_set, job.prefetched = job.prefetched, None
+            if order_set is not None and snapshot_age(order_set) > JOB_PREFETCH_MINUTES * 60 + ORDER_CACHE_TTL:
+                order_set = None
+            job.run(order_set)
+        except Exception as e:
+            logging.error(f"Ошибка задачи {job.name}: {e}")
+        finally:
+            job.lock.release()
+            try:
+                get_order_store().set_state(f'job_last_run:{job.name}', int(scheduled_at.timestamp() * 1000))
+            except Exception as e:
+                logging.error(f"Не удалось сохранить время запуска {job.name}: {e}")
+
+# Задачи по расписанию синхронного рантайма
+def build_sync_jobs():
+    prefetch = lambda: get_order_snapshot(force_refresh=True, allow_stale=False)
+    return [
+        DailyJob('overdue', JOB_OVERDUE_AT, job_overdue, prefetch=prefetch),
+        DailyJob('pending', JOB_PENDING_AT, job_pending, prefetch=prefetch),
+    ]
+
+# Наблюдатель за просрочкой: каждые ALERT_POLL_INTERVAL секунд догружает только новые заказы,
+# находит заказы, у которых наступило плановое время передачи без передачи курьеру,
+# перепроверяет их в API и отправляет по одному оповещению на заказ
+class OverdueWatcher:
+    def __init__(self, chat_ids, interval):
+        self.chat_ids = chat_ids
+        self.interval = interval
+        self._thread = None
+
+    # Поток запускается всегда: подписки на магазины (/subscribe) могут появиться после запуска
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='overdue-watcher', daemon=True)
+        self._thread.start()
+        logging.info(f"Оповещения о просрочке включены: проверка каждые {self.interval:.0f} сек.")
 
-# Планирование задач в UTC+5
-schedule.every().day.at("12:59").do(job_overdue)
-schedule.every().day.at("04:59").do(job_pending)
+    # Есть ли кому отправлять оповещения: чаты ALERT_CHAT_IDS или подписчики магазинов
+    def has_recipients(self):
+        return bool(self.chat_ids) or bool(get_order_store().store_subscribers())
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                if not self.has_recipients():
+                    time.sleep(self.interval)
+                    continue
+                self.poll()
+                metrics.inc('alert_polls_total', result='ok')
+            except Exception as e:
+                metrics.inc('alert_polls_total', result='error')
+                logging.error(f"Ошибка проверки просроченных заказов: {e}")
+            time.sleep(max(self.interval - (time.monotonic() - started), 1))
+
+    # Перезапрос заказов, созданных в периоде, с заменой их в локальной базе
+    def _refresh_range(self, store, start_ms, end_ms):
+        orders = fetch_orders_between(from_epoch_ms(start_ms), from_epoch_ms(end_ms))
+        store.replace_range(start_ms, end_ms, orders)
+
+    # Опоздавшие заказы из локальной базы, по которым еще не было оповещения
+    def _find_late(self, store, window_start_ms, alert_from_ms, now):
+        late = [
+            order for order in classify_late(store.load_orders(window_start_ms), now)
+            if order.planning_date > alert_from_ms
+        ]
+        new_codes = set(store.unalerted_codes(order.code for order in late))
+        return [order for order in late if order.code in new_codes]
+
+    def poll(self, now=None):
+        now = now or datetime.now(UTC_PLUS_5)
+        now_ms = int(now.timestamp() * 1000)
+        store = get_order_store()
+        start_date, _ = get_date_range()
+        window_start_ms = int(start_date.timestamp() * 1000)
+
+        if store.get_state('last_sync') is None:
+            sync_order_store(start_date, now)
+
+        # Новые заказы с прошлой проверки — обычно одна страница
+        last_poll_ms = store.get_state('alert_last_poll')
+        delta_start_ms = max(window_start_ms, (last_poll_ms or now_ms) - int(ALERT_POLL_OVERLAP * 1000))
+        self._refresh_range(store, delta_start_ms, now_ms)
+        store.set_state('alert_last_poll', now_ms)
+
+        # Оповещаем только о заказах, опоздавших после включения оповещений
+        alert_since_ms = store.get_state('alert_since')
+        if alert_since_ms is None:
+            store.set_state('alert_since', now_ms)
+            return []
+        alert_from_ms = max(alert_since_ms, now_ms - int(ALERT_MAX_LATENESS_HOURS * 3600 * 1000))
+
+        late = self._find_late(store, window_start_ms, alert_from_ms, now)
+        if not late:
+            return []
+
+        # Заказ мог быть передан курьеру после последней синхронизации: перезапрашиваем
+        # только период создания кандидатов, который не покрыла выгрузка новых заказов
+        verify_start_ms = min(order.creation_date for order in late)
+        verify_end_ms = min(max(order.creation_date for order in late), delta_start_ms - 1)
+        if verify_start_ms <= verify_end_ms:
+            self._refresh_range(store, verify_start_ms, verify_end_ms)
+            late = self._find_late(store, window_start_ms, alert_from_ms, now)
+
+        for order in late:
+            self.send_alert(order)
+            store.mark_alerted(order.code, now_ms)
+        return late
+
+    def send_alert(self, order):
+        text = (
+            f"⏰ Заказ {order.code} ({order.store}) не передан курьеру: "
+            f"плановое время передачи {from_epoch_ms(order.planning_date):%d.%m %H:%M}"
+        )
+        chat_ids = list(self.chat_ids)
+        try:
+            chat_ids.extend(
+                chat_id for chat_id in get_order_store().store_subscribers().get(order.store, [])
+                if str(chat_id) not in chat_ids
+            )
+        except Exception as e:
+            logging.error(f"Не удалось загрузить подписчиков магазина {order.store}: {e}")
+        for chat_id in chat_ids:
+            try:
+                telegram_pacer.call(bot.send_message, chat_id, text)
+                metrics.inc('alerts_sent_total')
+            except Exception as e:
+                logging.error(f"Не удалось отправить оповещение о заказе {order.code} в чат {chat_id}: {e}")
+
+overdue_watcher = OverdueWatcher(ALERT_CHAT_IDS, ALERT_POLL_INTERVAL)
+
+# Фоновые службы: планировщик, оповещения о просрочке, регистрация в Telegram и прогрев библиотек отчетов
+def start_background_services(webhook_url=None):
+    if BOT_MULTIPROCESS:
+        threading.Thread(
+            target=run_leader_election, args=(lambda: start_leader_services(webhook_url),),
+            name='leader-election', daemon=True
+        ).start()
+    else:
+        start_leader_services(webhook_url)
+
+    if STARTUP_MODE == 'eager':
+        warm_up_reporting()
+    elif STARTUP_WARMUP_DELAY >= 0:
+        warm_up_timer = threading.Timer(STARTUP_WARMUP_DELAY, warm_up_reporting)
+        warm_up_timer.daemon = True
+        warm_up_timer.start()
+
+# Службы, которые должны работать в одном экземпляре: рассылки по расписанию, оповещения, регистрация вебхука
+def start_leader_services(webhook_url=None):
+    JobScheduler(build_sync_jobs()).start()
+    overdue_watcher.start()
+    threading.Thread(target=register_telegram, args=(webhook_url,), daemon=True).start()
+
+# Ожидание блокировки ведущего: если ведущий процесс завершится, его место займет другой воркер
+leader_lock = LeaderLock(os.path.join(LOCK_DIR, 'leader.lock'))
+
+def run_leader_election(on_elected):
+    while not leader_lock.try_acquire():
+        time.sleep(LEADER_RETRY_INTERVAL)
+    logging.info(f"Процесс {os.getpid()} стал ведущим: запускаются планировщик и оповещения")
+    on_elected()
+
+# Виды отчетов: классификатор, лист, тема письма, текст письма, текст при отсутствии заказов
+REPORT_KINDS = {
+    'overdue': (classify_overdue, "Overdue Orders", "Delayed orders OMS", OVERDUE_EMAIL_BODY,
+                '❌ Нет просроченных заказов за указанный период.'),
+    'pending': (classify_pending, "Pending Orders", "Pending orders OMS", PENDING_EMAIL_BODY,
+                '❌ Нет заказов, ожидающих передачи курьеру за указанный период.'),
+}
+
+# ---------- Асинхронный рантайм (BOT_RUNTIME=async) ----------
+
+# Одна страница заказов через aiohttp; повторы, Retry-After и предохранитель — общие с fetch_orders_page (PageAttempt)
+async def async_fetch_orders_page(session, params, page_number, merchant):
+    page_params = {key: str(value) for key, value in params.items()}
+    page_params['page[number]'] = str(page_number)
+    headers = get_kaspi_headers(merchant)
+
+    for attempt in iter_page_attempts(merchant, page_number):
+        try:
+            delay = merchant.limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            attempt.sent()
+            async with session.get(API_URL, params=page_params, headers=headers) as response:
+                attempt.check_status(response.status, response.headers.get('Retry-After'))
+                data = await response.json(content_type=None)
+            attempt.succeeded()
+            return data
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KaspiRetryableError) as e:
+            delay = attempt.failed(e)
+        finally:
+            attempt.finish()
+        await asyncio.sleep(delay)
+
+# Асинхронный аналог fetch_order_pages: не больше concurrency страниц одновременно, отдаются по порядку
+async def async_iter_order_pages(session, params, merchant, concurrency=None, start_page=0):
+    concurrency = concurrency or KASPI_FETCH_CONCURRENCY
+    page_size = params['page[size]']
+
+    data = await async_fetch_orders_page(session, params, start_page, merchant)
+    orders, is_last = read_orders_page(data, start_page, page_size)
+    if orders:
+        yield orders
+    if is_last:
+        return
+
+    page_number = start_page + 1
+    page_count = (data.get('meta') or {}).get('pageCount')
+    if concurrency > 1 and page_count and page_count > page_number:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_limited(number):
+            async with semaphore:
+                return await async_fetch_orders_page(session, params, number, merchant)
+
+        tasks = [asyncio.create_task(fetch_limited(number)) for number in range(page_number, page_count)]
+        try:
+            for task in tasks:
+                orders, is_last = read_orders_page(await task, page_number, page_size)
+                if orders:
+                    yield orders
+                if is_last:
+                    return
+                page_number += 1
+        finally:
+            for task in tasks:
+                task.cancel()
 
-def run_scheduler():
     while True:
+        data = await async_fetch_orders_page(session, params, page_number, merchant)
+        orders, is_last = read_orders_page(data, page_number, page_size)
+        if orders:
+            yield orders
+        if is_last:
+            return
+        page_number += 1
+
+# Асинхронный аналог fetch_merchant_orders_timed: тот же план выгрузки и то же место обрыва (plan_merchant_crawl)
+async def async_fetch_merchant_orders(session, merchant, start_date, end_date, resume=False):
+    started_at = time.perf_counter()
+    try:
+        orders, steps = plan_merchant_crawl(merchant, start_date, end_date, resume)
+        for params, start_page in steps:
+            pages_done = 0
+            try:
+                async for page in async_iter_order_pages(session, params, merchant, start_page=start_page):
+                    orders.extend(parse_order(order) for order in page)
+                    pages_done += 1
+            except KaspiAPIError:
+                if resume:
+                    save_crawl_checkpoint(merchant, params, orders, start_page + pages_done)
+                raise
+            metrics.observe('kaspi_crawl_pages', pages_done, merchant=merchant.name)
+        orders = finish_merchant_crawl(orders, start_date)
+    except Exception as e:
+        record_merchant_fetch(merchant, started_at, error=e)
+        raise
+    record_merchant_fetch(merchant, started_at, len(orders))
+    return orders
+
+# Асинхронный аналог fetch_orders_between: продавцы выгружаются конкурентно
+async def async_fetch_orders_between(session, start_date, end_date, resume=False):
+    results = await asyncio.gather(
+        *(async_fetch_merchant_orders(session, merchant, start_date, end_date, resume) for merchant in merchants),
+        return_exceptions=True
+    )
+    return merge_merchant_results(results)
+
+# Асинхронный аналог fetch_order_set; работа с SQLite короткая и выполняется в потоке
+async def async_fetch_order_set(session):
+    with kaspi_fetch_errors():
+        start_date, today = get_date_range()
+        if KASPI_INCREMENTAL_SYNC:
+            store = get_order_store()
+            delta_start_ms, full_sync = await asyncio.to_thread(plan_order_sync, store, start_date, today)
+            orders = await async_fetch_orders_between(session, from_epoch_ms(delta_start_ms), today, resume=full_sync)
+            orders = await asyncio.to_thread(apply_order_sync, store, start_date, today, delta_start_ms, full_sync, orders)
+        else:
+            orders = await async_fetch_orders_between(session, start_date, today, resume=True)
+        return OrderSet(orders=orders, start_date=start_date, end_date=today)
+
+# Асинхронный рантайм: общий aiohttp клиент Kaspi, обработчики python-telegram-bot, вебхук и планировщик
+class AsyncBotRuntime:
+    def __init__(self):
+        self.session = None
+        self.application = None
+        self._snapshot_task = None
+        self._chat_locks = {}
+        self._registration_task = None
+
+    async def _load_snapshot(self):
+        snapshot = await async_fetch_order_set(self.session)
+        order_snapshot_cache.put(get_snapshot_key(), snapshot)
+        return snapshot
+
+    # Снимок заказов из общего кэша (тот же TTL, запасной снимок и allow_stale, что и get_order_snapshot);
+    # одновременные запросы ждут одну выгрузку
+    async def get_order_snapshot(self, force_refresh=False, allow_stale=True):
+        snapshot = None if force_refresh else order_snapshot_cache.fresh(get_snapshot_key())
+        if snapshot is not None:
+            return snapshot
+        if self._snapshot_task is None:
+            self._snapshot_task = asyncio.create_task(self._load_snapshot())
+        task = self._snapshot_task
         try:
-            schedule.run_pending()
-            time.sleep(1)
+            return await asyncio.shield(task)
+        except KaspiAPIError as e:
+            snapshot = get_fallback_snapshot(e, allow_stale)
+            if snapshot is None:
+                raise
+            return snapshot
+        finally:
+            if task.done() and self._snapshot_task is task:
+                self._snapshot_task = None
+
+    # Отправка с соблюдением лимитов Telegram и повтором после RetryAfter (общий TelegramPacer)
+    async def send(self, method, chat_id, *args, **kwargs):
+        return await telegram_pacer.call_async(method, chat_id, *args, **kwargs)
+
+    # Асинхронный аналог send_reply_steps; шаги (Excel, скриншот, файл) готовятся в потоке
+    async def send_steps(self, chat_id, steps, status=None):
+        bot_api = self.application.bot
+        while True:
+            step = await asyncio.to_thread(next, steps, None)
+            if step is None:
+                return
+            kind, value = step
+            if kind == 'status':
+                await status.edit_text(value)
+            elif kind == 'message':
+                await self.send(bot_api.send_message, chat_id, value)
+            elif kind == 'document':
+                await self.send(bot_api.send_document, chat_id, value, filename=value.name)
+            else:
+                await self.send(bot_api.send_photo, chat_id, value)
+
+    async def send_lines(self, chat_id, lines, file_threshold=None, file_name='orders.txt'):
+        await self.send_steps(chat_id, iter_message_parts(lines, file_threshold, file_name))
+
+    # Команды одного чата выполняются по очереди
+    def command(self, handler, with_args=False):
+        async def wrapper(update, context):
+            chat_id = update.effective_chat.id
+            lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+            async with lock:
+                try:
+                    if with_args:
+                        await handler(chat_id, context.args or [])
+                    else:
+                        await handler(chat_id)
+                except Exception as e:
+                    logging.error(f"Ошибка при обработке команды: {e}")
+                    await self.send(context.bot.send_message, chat_id, f'Произошла ошибка: {e}')
+        return wrapper
+
+    # Тот же ответ, что и reply_with_orders синхронного рантайма (iter_orders_reply)
+    async def reply_with_orders(self, chat_id, kind):
+        classifier = REPORT_KINDS[kind][0]
+        status = await self.send(self.application.bot.send_message, chat_id, '🔄 Получение списка заказов...')
+        order_set = await self.get_order_snapshot()
+        orders_by_store = await asyncio.to_thread(lambda: group_by_store(classifier(order_set)))
+        await self.send_steps(chat_id, iter_orders_reply(kind, orders_by_store, order_set), status)
+
+    # Отчет по email; Excel, картинка и SMTP выполняются в потоках, цикл событий не блокируется.
+    # Письмо строится только по свежим данным: в письме и в архиве возраст снимка не виден
+    async def send_report_email(self, classifier, sheet_name, subject, email_body, order_set=None, archive_kind=None):
+        if order_set is None:
+            order_set = await self.get_order_snapshot(allow_stale=False)
+        orders_by_store = group_by_store(classifier(order_set))
+        if archive_kind is not None:
+            await asyncio.to_thread(archive_report_run, archive_kind, order_set, orders_by_store)
+        if not orders_by_store:
+            return None
+        report_file = await asyncio.to_thread(create_report_file, orders_by_store, sheet_name)
+        statistics_image = await asyncio.to_thread(create_statistics_screenshot, count_by_store(orders_by_store))
+        return await asyncio.to_thread(send_email, report_file, statistics_image, subject, email_body)
+
+    async def report_command(self, chat_id, kind):
+        classifier, sheet_name, subject, email_body, empty_text = REPORT_KINDS[kind]
+        status = await self.send(self.application.bot.send_message, chat_id, '🔄 Запуск отчета...')
+        sent = await self.send_report_email(classifier, sheet_name, subject, email_body)
+        if sent is None:
+            await status.edit_text(empty_text)
+        elif sent:
+            await status.edit_text('✅ Отчет успешно отправлен по электронной почте.')
+        else:
+            await status.edit_text('❌ Не удалось отправить отчет по электронной почте.')
+
+    async def stats_command(self, chat_id, args):
+        chart, lines = await asyncio.to_thread(build_stats_reply, args)
+        await self.send(self.application.bot.send_photo, chat_id, chart)
+        await self.send_lines(chat_id, lines)
+
+    # Последний снимок для ответов по индексам; выгрузка — только если он старше ORDER_INDEX_MAX_AGE
+    async def get_indexed_snapshot(self):
+        order_set = order_snapshot_cache.fresh(get_snapshot_key(), ORDER_INDEX_MAX_AGE)
+        if order_set is not None:
+            return order_set
+        return await self.get_order_snapshot()
+
+    async def store_orders_command(self, chat_id, kind, args):
+        order_set = await self.get_indexed_snapshot()
+        lines = await asyncio.to_thread(build_store_reply, order_set, kind, ' '.join(args))
+        await self.send_lines(chat_id, lines, file_threshold=MESSAGE_FILE_THRESHOLD,
+                              file_name=get_report_file_name(REPORT_KINDS[kind][1], 'txt'))
+
+    async def order_command(self, chat_id, args):
+        order_set = await self.get_indexed_snapshot()
+        lines = await asyncio.to_thread(build_order_reply, order_set, ' '.join(args))
+        await self.send_lines(chat_id, lines)
+
+    async def subscription_command(self, chat_id, args, subscribe):
+        lines = await asyncio.to_thread(build_subscription_reply, chat_id, ' '.join(args), subscribe)
+        await self.send_lines(chat_id, lines)
+
+    async def refresh_command(self, chat_id):
+        order_set = await self.get_order_snapshot(force_refresh=True, allow_stale=False)
+        await self.send(self.application.bot.send_message, chat_id,
+                        format_refresh_reply(order_set))
+
+    def build_application(self):
+        application = telegram_ext.ApplicationBuilder().token(API_KEY).updater(None).concurrent_updates(True).build()
+        application.add_handler(telegram_ext.CommandHandler('orders', self.command(lambda chat_id, args: self.store_orders_command(
+            chat_id, 'overdue', args) if args else self.reply_with_orders(chat_id, 'overdue'), with_args=True)))
+        application.add_handler(telegram_ext.CommandHandler('pending_orders', self.command(lambda chat_id, args: self.store_orders_command(
+            chat_id, 'pending', args) if args else self.reply_with_orders(chat_id, 'pending'), with_args=True)))
+        application.add_handler(telegram_ext.CommandHandler('order', self.command(self.order_command, with_args=True)))
+        application.add_handler(telegram_ext.CommandHandler('subscribe', self.command(
+            lambda chat_id, args: self.subscription_command(chat_id, args, subscribe=True), with_args=True)))
+        application.add_handler(telegram_ext.CommandHandler('unsubscribe', self.command(
+            lambda chat_id, args: self.subscription_command(chat_id, args, subscribe=False), with_args=True)))
+        application.add_handler(telegram_ext.CommandHandler('send_report', self.command(lambda chat_id: self.report_command(chat_id, 'overdue'))))
+        application.add_handler(telegram_ext.CommandHandler('send_pending_report', self.command(lambda chat_id: self.report_command(chat_id, 'pending'))))
+        application.add_handler(telegram_ext.CommandHandler('refresh', self.command(self.refresh_command)))
+        application.add_handler(telegram_ext.CommandHandler('stats', self.command(self.stats_command, with_args=True)))
+        return application
+
+    # Рассылка по расписанию; ошибки логируются, итог попадает в /healthz
+    async def scheduled_report(self, kind, order_set=None):
+        classifier, sheet_name, subject, email_body, _ = REPORT_KINDS[kind]
+        started_at = time.perf_counter()
+        result = 'failed'
+        try:
+            logging.info(f"Запуск автоотправки отчета ({kind})...")
+            if order_set is None:
+                order_set = await self.get_order_snapshot(allow_stale=False)
+            sent = await self.send_report_email(classifier, sheet_name, subject, email_body, order_set, archive_kind=kind)
+            for chat_id, steps in await asyncio.to_thread(list, iter_subscriber_messages(kind, order_set)):
+                try:
+                    await self.send_steps(chat_id, steps)
+                except Exception as e:
+                    logging.error(f"Не удалось отправить список заказов подписчику {chat_id}: {e}")
+            result = 'empty' if sent is None else 'sent' if sent else 'failed'
+            logging.info(f"Автоотправка отчета ({kind}) завершена: {sent}")
         except Exception as e:
-            logging.error(f"Ошибка в планировщике: {e}")
-            time.sleep(15)
+            logging.error(f"Ошибка при автоотправке отчета ({kind}): {e}")
+        finally:
+            record_job_run(kind, started_at, result)
+
+    # Задачи общего планировщика: он работает в своем потоке и выполняет корутины на цикле событий рантайма
+    def build_jobs(self, loop):
+        def run_on_loop(coroutine_factory):
+            return lambda *args: asyncio.run_coroutine_threadsafe(coroutine_factory(*args), loop).result()
+
+        prefetch = run_on_loop(lambda: self.get_order_snapshot(force_refresh=True, allow_stale=False))
+        return [
+            DailyJob('overdue', JOB_OVERDUE_AT, run_on_loop(lambda order_set: self.scheduled_report('overdue', order_set)),
+                     prefetch=prefetch),
+            DailyJob('pending', JOB_PENDING_AT, run_on_loop(lambda order_set: self.scheduled_report('pending', order_set)),
+                     prefetch=prefetch),
+        ]
+
+    async def handle_metrics(self, request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    async def handle_health(self, request):
+        health = get_health()
+        return web.json_response(health, status=503 if health['status'] == 'down' else 200)
+
+    async def handle_webhook(self, request):
+        update = telegram.Update.de_json(await request.json(), self.application.bot)
+        await self.application.update_queue.put(update)
+        return web.Response(text='ok')
+
+    async def serve(self, port, webhook_url=None):
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=KASPI_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=max(KASPI_FETCH_CONCURRENCY, 1))
+        )
+        self.application = self.build_application()
+        await self.application.initialize()
+        await self.application.start()
+        # Меню команд и вебхук регистрируются той же функцией, что и в синхронном рантайме, в фоне с повторами
+        self._registration_task = asyncio.create_task(asyncio.to_thread(register_telegram, webhook_url))
+
+        JobScheduler(self.build_jobs(asyncio.get_running_loop())).start()
+        overdue_watcher.start()
+
+        web_app = web.Application()
+        web_app.router.add_post('/' + API_KEY, self.handle_webhook)
+        web_app.router.add_get('/', lambda request: web.Response(text='Hello, World!'))
+        web_app.router.add_get('/metrics', self.handle_metrics)
+        web_app.router.add_get('/healthz', self.handle_health)
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', port).start()
+        logging.info(f"Асинхронный рантайм запущен на порту {port}")
 
-scheduler_thread = threading.Thread(target=run_scheduler)
-scheduler_thread.daemon = True
-scheduler_thread.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            await self.application.stop()
+            await self.application.shutdown()
+            await self.session.close()
+
+# Очередь обработки обновлений: команды одного чата выполняются по очереди, разных чатов — параллельно
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '100'))
+
+def get_update_chat_id(update):
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    return None
+
+class UpdateDispatcher:
+    def __init__(self, workers, max_pending):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update')
+        self._lock = threading.Lock()
+        self._chat_queues = {}
+        self._pending = 0
+
+    # Ставит обновление в очередь; False, если очередь переполнена
+    def submit(self, update):
+        chat_id = get_update_chat_id(update)
+        key = chat_id if chat_id is not None else ('update', update.update_id)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            queue = self._chat_queues.get(key)
+            if queue is not None:
+                queue.append(update)
+                return True
+            self._chat_queues[key] = deque([update])
+        self._executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._chat_queues[key]
+                if not queue:
+                    del self._chat_queues[key]
+                    return
+                update = queue.popleft()
+            try:
+                # Команды одного чата не выполняются одновременно и в разных процессах-воркерах
+                with process_lock(f'chat-{key}') if BOT_MULTIPROCESS and isinstance(key, int) else nullcontext():
+                    bot.process_new_updates([update])
+            except Exception as e:
+                logging.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+
+update_dispatcher = UpdateDispatcher(WEBHOOK_WORKERS, WEBHOOK_MAX_PENDING)
+
+# Отметка о приеме обновления в общей базе; при ошибке базы обновление обрабатывается
+def claim_update(update):
+    try:
+        return get_order_store().claim_update(update.update_id, int(time.time() * 1000))
+    except Exception as e:
+        logging.error(f"Не удалось отметить обновление {update.update_id}: {e}")
+        return True
 
 # Инициализация Flask приложения
 app = Flask(__name__)
@@ -588,20 +3499,48 @@ app = Flask(__name__)
 @app.route('/' + API_KEY, methods=['POST'])
 def webhook():
     update = telebot.types.Update.de_json(request.stream.read().decode('utf-8'))
-    bot.process_new_updates([update])
+    # Повторную доставку обновления, уже принятого другим воркером, не обрабатываем
+    if BOT_MULTIPROCESS and not claim_update(update):
+        logging.info(f"Обновление {update.update_id} уже принято, повтор пропущен")
+        return 'ok', 200
+    # Отвечаем сразу, обработка идет в фоне; при переполнении Telegram повторит доставку позже
+    if not update_dispatcher.submit(update):
+        logging.warning("Очередь обновлений переполнена, обновление будет доставлено повторно.")
+        if BOT_MULTIPROCESS:
+            get_order_store().release_update(update.update_id)
+        return 'busy', 503
     return 'ok', 200
 
 @app.route('/')
 def index():
     return 'Hello, World!'
 
+# Метрики в текстовом формате Prometheus
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Живость планировщика и итог последнего запуска каждой задачи
+@app.route('/healthz')
+def healthz():
+    health = get_health()
+    return jsonify(health), 503 if health['status'] == 'down' else 200
+
+startup_timings['module_import'] = time.perf_counter() - STARTUP_STARTED
+logging.info(f"Модуль бота загружен за {startup_timings['module_import']:.2f} сек. (режим запуска: {STARTUP_MODE})")
+
 # Запуск бота
 if __name__ == '__main__':
     try:
-        bot.remove_webhook()
-        bot.set_webhook(url=f'https://nbot-n94j.onrender.com/{API_KEY}')
+        webhook_url = WEBHOOK_URL
         port = int(os.environ.get('PORT', 5000))
-        app.run(host='0.0.0.0', port=port)
+        if BOT_RUNTIME == 'async':
+            asyncio.run(AsyncBotRuntime().serve(port, webhook_url=webhook_url))
+        else:
+            start_background_services(webhook_url=webhook_url)
+            startup_timings['ready'] = time.perf_counter() - STARTUP_STARTED
+            logging.info(f"Бот готов принимать обновления через {startup_timings['ready']:.2f} сек. после старта")
+            app.run(host='0.0.0.0', port=port)
     except Exception as e:
         logging.error(f"Ошибка в основном цикле: {e}")
 
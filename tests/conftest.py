@@ -0,0 +1,13 @@
+import os
+import sys
+
+# Бот не должен ходить в реальные сервисы: фиктивные ключи и полная выгрузка без локальной базы
+os.environ.setdefault('TELEGRAM_API_KEY', '000000:TEST')
+os.environ.setdefault('KASPI_AUTH_TOKEN', 'test')
+os.environ.setdefault('KASPI_INCREMENTAL_SYNC', '0')
+os.environ.setdefault('KASPI_TOKEN_RPS', '0')
+os.environ.setdefault('EMAIL_FROM', 'bot@example.com')
+os.environ.setdefault('EMAIL_TO', 'to@example.com')
+os.environ.setdefault('EMAIL_CC', 'cc@example.com')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,200 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+import requests
+
+import benchmark
+import kaspi_bot
+
+
+@pytest.fixture
+def kaspi_server(monkeypatch):
+    now_ms = int(time.time() * 1000)
+    with benchmark.MockKaspiServer(benchmark.make_synthetic_orders(1000, now_ms)) as server:
+        monkeypatch.setattr(kaspi_bot, 'API_URL', server.url)
+        monkeypatch.setattr(kaspi_bot, 'KASPI_BACKOFF_BASE', 0.01)
+        monkeypatch.setattr(kaspi_bot, 'KASPI_MAX_ATTEMPTS', 3)
+        monkeypatch.setattr(kaspi_bot, '_crawl_checkpoints', {})
+        yield server
+
+
+def make_merchant(threshold=100, cooldown=60.0):
+    return kaspi_bot.Merchant(
+        name='test', token_value='test', circuit=kaspi_bot.CircuitBreaker(threshold, cooldown)
+    )
+
+
+def fetch_first_page(merchant, session=None):
+    start_date, end_date = kaspi_bot.get_date_range()
+    params = kaspi_bot.build_orders_params(start_date, end_date)
+    return kaspi_bot.fetch_orders_page(session or requests.Session(), params, 0, merchant)
+
+
+def test_retries_5xx_then_returns_page(kaspi_server):
+    kaspi_server.fail(503, times=2)
+
+    data = fetch_first_page(make_merchant())
+
+    assert len(data['data']) == 100
+    assert kaspi_server.requests == 3
+
+
+def test_non_retryable_4xx_is_not_retried(kaspi_server):
+    kaspi_server.fail(401)
+
+    with pytest.raises(kaspi_bot.KaspiAPIError, match='401'):
+        fetch_first_page(make_merchant())
+    assert kaspi_server.requests == 1
+
+
+def test_retry_after_is_honoured(kaspi_server, monkeypatch):
+    monkeypatch.setattr(kaspi_bot, 'KASPI_BACKOFF_BASE', 0)
+    kaspi_server.fail(429, retry_after='0.3')
+
+    started = time.monotonic()
+    fetch_first_page(make_merchant())
+
+    assert time.monotonic() - started >= 0.3
+    assert kaspi_server.requests == 2
+
+
+def test_interrupted_crawl_resumes_from_failed_page(kaspi_server, monkeypatch):
+    merchant = make_merchant()
+    monkeypatch.setattr(kaspi_bot, 'merchants', [merchant])
+    monkeypatch.setattr(kaspi_bot, 'KASPI_FETCH_CONCURRENCY', 1)
+    start_date, end_date = kaspi_bot.get_date_range()
+    kaspi_server.fail(503, times=kaspi_bot.KASPI_MAX_ATTEMPTS, page=5)
+
+    with pytest.raises(kaspi_bot.KaspiAPIError):
+        kaspi_bot.fetch_orders_between(start_date, end_date, resume=True)
+    assert kaspi_bot._crawl_checkpoints['test']['next_page'] == 5
+
+    kaspi_server.requested_pages.clear()
+    orders = kaspi_bot.fetch_orders_between(start_date, end_date, resume=True)
+
+    assert len({order.code for order in orders}) == 1000
+    # Продолжение со страницы 5 и первая страница заказов, созданных после прерванной выгрузки
+    assert kaspi_server.requested_pages[0] == 5
+    assert not set(kaspi_server.requested_pages) & {1, 2, 3, 4}
+
+
+def test_failed_parallel_crawl_stops_fetching_pages(kaspi_server):
+    merchant = make_merchant()
+    start_date, end_date = kaspi_bot.get_date_range()
+    params = kaspi_bot.build_orders_params(start_date, end_date)
+    kaspi_server.fail(503, times=kaspi_bot.KASPI_MAX_ATTEMPTS, page=3)
+
+    with pytest.raises(kaspi_bot.KaspiAPIError):
+        for _ in kaspi_bot.fetch_order_pages(params, merchant, concurrency=4):
+            pass
+
+    # Вперед запрашивается не больше 4 страниц, хвост выгрузки после ошибки не скачивается
+    assert max(kaspi_server.requested_pages) < 8
+
+
+def test_short_queries_leave_the_checkpoint_alone(kaspi_server, monkeypatch):
+    merchant = make_merchant()
+    monkeypatch.setattr(kaspi_bot, 'merchants', [merchant])
+    monkeypatch.setattr(kaspi_bot, 'KASPI_FETCH_CONCURRENCY', 1)
+    start_date, end_date = kaspi_bot.get_date_range()
+    kaspi_server.fail(503, times=kaspi_bot.KASPI_MAX_ATTEMPTS, page=5)
+    with pytest.raises(kaspi_bot.KaspiAPIError):
+        kaspi_bot.fetch_orders_between(start_date, end_date, resume=True)
+    checkpoint = kaspi_bot._crawl_checkpoints['test']
+
+    # Опрос оповещений за последние минуты — один запрос, место обрыва не тронуто
+    kaspi_server.requested_pages.clear()
+    kaspi_bot.fetch_orders_between(end_date - kaspi_bot.timedelta(minutes=12), end_date)
+    assert kaspi_server.requested_pages == [0]
+    # Полная выгрузка с другим окном тоже не продолжает чужую выгрузку
+    kaspi_server.requested_pages.clear()
+    kaspi_bot.fetch_orders_between(start_date + kaspi_bot.timedelta(days=1), end_date, resume=True)
+    assert kaspi_server.requested_pages[0] == 0
+
+    monkeypatch.setitem(kaspi_bot._crawl_checkpoints, 'test', checkpoint)
+    kaspi_server.requested_pages.clear()
+    kaspi_bot.fetch_orders_between(start_date, end_date, resume=True)
+    assert kaspi_server.requested_pages[0] == 5
+
+
+def test_circuit_opens_and_recovers_when_check_request_gets_4xx(kaspi_server, monkeypatch):
+    monkeypatch.setattr(kaspi_bot, 'KASPI_MAX_ATTEMPTS', 1)
+    merchant = make_merchant(threshold=2, cooldown=0.2)
+    kaspi_server.fail(500, times=2)
+    kaspi_server.fail(401, times=1)
+
+    for _ in range(2):
+        with pytest.raises(kaspi_bot.KaspiAPIError, match='500'):
+            fetch_first_page(merchant)
+    with pytest.raises(kaspi_bot.KaspiCircuitOpenError):
+        fetch_first_page(merchant)
+    assert kaspi_server.requests == 2
+
+    time.sleep(0.25)
+    with pytest.raises(kaspi_bot.KaspiAPIError, match='401'):
+        fetch_first_page(merchant)
+
+    assert len(fetch_first_page(merchant)['data']) == 100
+    assert not merchant.circuit.is_open()
+
+
+def test_circuit_check_request_is_released_on_unexpected_error(kaspi_server, monkeypatch):
+    monkeypatch.setattr(kaspi_bot, 'KASPI_MAX_ATTEMPTS', 1)
+    merchant = make_merchant(threshold=1, cooldown=0.1)
+    kaspi_server.fail(500)
+    with pytest.raises(kaspi_bot.KaspiAPIError):
+        fetch_first_page(merchant)
+    time.sleep(0.15)
+
+    class BrokenSession:
+        def get(self, *args, **kwargs):
+            raise RuntimeError('соединение оборвано')
+
+    with pytest.raises(RuntimeError):
+        fetch_first_page(merchant, BrokenSession())
+
+    assert len(fetch_first_page(merchant)['data']) == 100
+
+
+def test_async_circuit_recovers_when_check_request_gets_4xx(kaspi_server, monkeypatch):
+    monkeypatch.setattr(kaspi_bot, 'KASPI_MAX_ATTEMPTS', 1)
+    merchant = make_merchant(threshold=1, cooldown=0.1)
+    start_date, end_date = kaspi_bot.get_date_range()
+    params = kaspi_bot.build_orders_params(start_date, end_date)
+    kaspi_server.fail(500)
+    kaspi_server.fail(403)
+
+    async def scenario():
+        async with aiohttp.ClientSession() as session:
+            with pytest.raises(kaspi_bot.KaspiAPIError, match='500'):
+                await kaspi_bot.async_fetch_orders_page(session, params, 0, merchant)
+            await asyncio.sleep(0.15)
+            with pytest.raises(kaspi_bot.KaspiAPIError, match='403'):
+                await kaspi_bot.async_fetch_orders_page(session, params, 0, merchant)
+            return await kaspi_bot.async_fetch_orders_page(session, params, 0, merchant)
+
+    assert len(asyncio.run(scenario())['data']) == 100
+
+
+def test_async_crawl_shares_the_resume_checkpoint(kaspi_server, monkeypatch):
+    merchant = make_merchant()
+    monkeypatch.setattr(kaspi_bot, 'merchants', [merchant])
+    monkeypatch.setattr(kaspi_bot, 'KASPI_FETCH_CONCURRENCY', 1)
+    start_date, end_date = kaspi_bot.get_date_range()
+    kaspi_server.fail(503, times=kaspi_bot.KASPI_MAX_ATTEMPTS, page=5)
+
+    async def crawl():
+        async with aiohttp.ClientSession() as session:
+            return await kaspi_bot.async_fetch_orders_between(session, start_date, end_date, resume=True)
+
+    with pytest.raises(kaspi_bot.KaspiAPIError):
+        asyncio.run(crawl())
+    assert kaspi_bot._crawl_checkpoints['test']['next_page'] == 5
+
+    kaspi_server.requested_pages.clear()
+    orders = asyncio.run(crawl())
+
+    assert len({order.code for order in orders}) == 1000
+    assert kaspi_server.requested_pages[0] == 5
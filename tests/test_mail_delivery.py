@@ -0,0 +1,163 @@
+import smtplib
+import socketserver
+import threading
+
+import pytest
+
+import kaspi_bot
+
+
+# Минимальный SMTP сервер: считает соединения, сохраняет письма и отвечает на DATA кодами из data_replies
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.commands = []
+        self.messages = []
+        self.data_replies = []
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        recipients = []
+        self.reply('220 stand-in ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').strip()
+            verb = command.split(' ', 1)[0].upper()
+            server.commands.append(verb)
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 stand-in')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip('<> '))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''
+                while not data.endswith(b'\r\n.\r\n'):
+                    data += self.rfile.readline()
+                reply = server.data_replies.pop(0) if server.data_replies else '250 OK'
+                if reply.startswith('250'):
+                    server.messages.append((recipients, data))
+                self.reply(reply)
+            elif verb in ('NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    server = SMTPStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(kaspi_bot, 'SMTP_HOST', '127.0.0.1')
+    monkeypatch.setattr(kaspi_bot, 'SMTP_PORT', server.server_address[1])
+    monkeypatch.setattr(kaspi_bot, 'SMTP_STARTTLS', False)
+    monkeypatch.setattr(kaspi_bot, 'SMTP_BACKOFF_BASE', 0.01)
+    monkeypatch.delenv('EMAIL_PASSWORD', raising=False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def delivery():
+    mail_delivery = kaspi_bot.MailDelivery()
+    yield mail_delivery
+    mail_delivery.close()
+
+
+def test_connection_is_reused_between_messages(smtp_server, delivery):
+    delivery.send('bot@example.com', ['a@example.com'], b'Subject: 1\r\n\r\nfirst')
+    delivery.send('bot@example.com', ['a@example.com'], b'Subject: 2\r\n\r\nsecond')
+
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 2
+    # Перед вторым письмом соединение проверяется NOOP, а не открывается заново
+    assert 'NOOP' in smtp_server.commands
+
+
+def test_transient_error_is_retried_with_the_same_bytes(smtp_server, delivery):
+    smtp_server.data_replies = ['451 Try again later']
+    message = b'Subject: report\r\n\r\nbody'
+
+    delivery.send('bot@example.com', ['a@example.com', 'b@example.com'], message)
+
+    assert smtp_server.commands.count('DATA') == 2
+    assert smtp_server.connections == 2
+    recipients, data = smtp_server.messages[0]
+    assert recipients == ['a@example.com', 'b@example.com']
+    assert data.startswith(message)
+
+
+def test_permanent_error_is_not_retried(smtp_server, delivery):
+    smtp_server.data_replies = ['550 Mailbox unavailable']
+
+    with pytest.raises(smtplib.SMTPDataError):
+        delivery.send('bot@example.com', ['a@example.com'], b'Subject: report\r\n\r\nbody')
+
+    assert smtp_server.commands.count('DATA') == 1
+
+
+def test_gives_up_after_max_attempts(smtp_server, delivery, monkeypatch):
+    monkeypatch.setattr(kaspi_bot, 'SMTP_MAX_ATTEMPTS', 3)
+    smtp_server.data_replies = ['451 Try again later'] * 3
+
+    with pytest.raises(smtplib.SMTPDataError):
+        delivery.send('bot@example.com', ['a@example.com'], b'Subject: report\r\n\r\nbody')
+
+    assert smtp_server.commands.count('DATA') == 3
+    assert smtp_server.messages == []
+
+
+def test_queued_reports_share_one_connection(smtp_server, delivery):
+    futures = [
+        delivery.enqueue('bot@example.com', ['a@example.com'], f'Subject: {number}\r\n\r\nbody'.encode())
+        for number in range(3)
+    ]
+
+    assert [future.result(timeout=10) for future in futures] == [True, True, True]
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 3
+
+
+def test_enqueue_does_not_wait_for_a_batch_in_progress(smtp_server, delivery):
+    # Пакет, отправляемый прямо сейчас (в том числе с паузами повторов), держит _lock
+    with delivery._lock:
+        started = threading.Event()
+        thread = threading.Thread(target=lambda: (
+            delivery.enqueue('bot@example.com', ['a@example.com'], b'Subject: 1\r\n\r\nbody'), started.set()))
+        thread.start()
+        assert started.wait(timeout=2)
+    thread.join()
+
+
+def test_report_email_goes_to_all_recipients_in_one_transaction(smtp_server, delivery, monkeypatch):
+    monkeypatch.setattr(kaspi_bot, 'mail_delivery', delivery)
+    monkeypatch.setenv('EMAIL_TO', 'to1@example.com,to2@example.com')
+    monkeypatch.setenv('EMAIL_CC', 'cc@example.com')
+    report_file = kaspi_bot.BytesIO(b'report')
+    report_file.name = 'overdue.csv'
+    image = kaspi_bot.BytesIO(b'\x89PNG\r\n\x1a\n')
+    image.name = 'statistics.png'
+
+    assert kaspi_bot.send_email(report_file, image, 'Delayed orders OMS', kaspi_bot.OVERDUE_EMAIL_BODY)
+
+    assert smtp_server.commands.count('DATA') == 1
+    recipients, _ = smtp_server.messages[0]
+    assert recipients == ['to1@example.com', 'to2@example.com', 'cc@example.com']
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import kaspi_bot
+
+NOW = datetime(2024, 3, 12, 15, 0, tzinfo=kaspi_bot.UTC_PLUS_5)
+TODAY = NOW.replace(hour=0, minute=0)
+WAREHOUSE = kaspi_bot.store_mapping['14576033_9041']
+STORE = kaspi_bot.store_mapping['14576033_9005']
+
+
+def make_order(planned=None, transmitted=False, store=STORE):
+    planning_date = int(planned.timestamp() * 1000) if planned is not None else None
+    return kaspi_bot.Order(
+        code=str(planning_date), pickup_point_id='', store=store, planning_date=planning_date,
+        transmission_date=planning_date if transmitted else None, creation_date=None,
+    )
+
+
+def select(classifier, order):
+    return list(classifier([order], NOW)) == [order]
+
+
+@pytest.mark.parametrize('planned, transmitted, overdue, late', [
+    (TODAY - timedelta(days=1, hours=-10), False, True, True),
+    (NOW - timedelta(milliseconds=1), False, True, True),
+    (NOW, False, True, False),
+    (TODAY.replace(hour=22, minute=59, second=59), False, True, False),
+    (TODAY.replace(hour=23), False, False, False),
+    (TODAY + timedelta(days=1), False, False, False),
+    (TODAY - timedelta(days=1), True, False, False),
+    (None, False, False, False),
+])
+def test_overdue_and_late_boundaries(planned, transmitted, overdue, late):
+    order = make_order(planned, transmitted)
+
+    assert select(kaspi_bot.classify_overdue, order) is overdue
+    assert select(kaspi_bot.classify_late, order) is late
+
+
+@pytest.mark.parametrize('planned, transmitted, store, pending', [
+    (TODAY, False, STORE, True),
+    (TODAY.replace(hour=23, minute=59, second=59), False, STORE, True),
+    (TODAY - timedelta(milliseconds=1), False, STORE, False),
+    (TODAY + timedelta(days=1), False, STORE, False),
+    (TODAY + timedelta(hours=12), True, STORE, False),
+    (None, False, STORE, False),
+    (None, False, WAREHOUSE, True),
+    (TODAY - timedelta(days=5), False, WAREHOUSE, True),
+    (TODAY, True, WAREHOUSE, False),
+])
+def test_pending_boundaries_and_warehouse_rule(planned, transmitted, store, pending):
+    assert select(kaspi_bot.classify_pending, make_order(planned, transmitted, store)) is pending
+
+
+def test_stream_order_and_report_grouping_agree():
+    orders = [
+        make_order(NOW - timedelta(minutes=minutes), transmitted=minutes % 3 == 0,
+                   store=WAREHOUSE if minutes % 5 == 0 else STORE)
+        for minutes in range(1200)
+    ]
+    order_set = kaspi_bot.OrderSet(orders=orders, start_date=NOW - timedelta(days=14), end_date=NOW)
+
+    streamed = list(kaspi_bot.classify_overdue(iter(orders), NOW))
+    grouped = kaspi_bot.group_frame_by_store(order_set.frame, kaspi_bot.overdue_mask(order_set.frame, NOW))
+
+    assert streamed == [order for order in orders if order.transmission_date is None]
+    assert kaspi_bot.group_by_store(streamed) == grouped